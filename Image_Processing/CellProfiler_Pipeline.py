@@ -5,6 +5,7 @@ import omero
 from omero.gateway import BlitzGateway
 from omero.rtypes import rstring, rlong, robject
 import omero.scripts as scripts
+from localisation_utils import get_download_cache_path,touch_cached_download,iter_cached_download
 
 import os
 import csv
@@ -174,10 +175,19 @@ def download_pipeline(pipeline):
     
     filename = pipeline.getFile().getName()
     file_path = os.path.join(input_dir, filename)
+    cache_file = get_download_cache_path(pipeline)
+    if cache_file is not None and touch_cached_download(cache_file):
+        print( "\nCopying cached download", cache_file, "to", file_path )
+        try:
+            shutil.copyfile(cache_file, file_path)
+            return file_path,filename
+        except IOError:
+            # evicted by another script, download it again
+            pass
     f = open(str(file_path), 'w')
     print( "\nDownloading file to", file_path, "..." )
     try:
-        for chunk in pipeline.getFileInChunks():
+        for chunk in iter_cached_download(pipeline):
             f.write(chunk)
     finally:
         f.close()
@@ -17,6 +17,7 @@ import os
 import glob
 import tempfile
 from ome_metadata import OMEExporter
+from save_utils import save_in_batches, new_image_links
 import shutil
 
 from email.MIMEMultipart import MIMEMultipart
@@ -474,14 +475,8 @@ def process_image(conn, parent_id, script_params, session):
         print "No dataset created or found for new images."\
             " Images will be orphans."
     else:
-        link = []
-        for cid in child_ids:
-            dsLink = omero.model.DatasetImageLinkI()
-            dsLink.parent = omero.model.DatasetI(
-                parentDataset.id.val, False)
-            dsLink.child = omero.model.ImageI(cid, False)
-            updateService.saveObject(dsLink)
-            link.append(dsLink)
+        link = save_in_batches(conn,
+                               new_image_links(parentDataset.id.val, child_ids))
         if parentProject and parentProject.canLink():
             # and put it in the   current project
             projectLink = omero.model.ProjectDatasetLinkI()
@@ -16,6 +16,9 @@ import pandas as pd
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import *
+from localisation_utils import (strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,iter_locs_chunks)
+from save_utils import save_in_batches,new_image_links
 import tempfile
 import glob
 import itertools
@@ -105,7 +108,6 @@ FILE_TYPES = {
                                  'chan_col': 'Channel'
                                  }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
 
 def calc_hist(data,file_type,nr,nc,size_r,size_c):
     """
@@ -121,122 +123,7 @@ def calc_hist(data,file_type,nr,nc,size_r,size_c):
 
     x = file_type['x_col']
     y = file_type['y_col']
-    return histogramdd(data.loc[:,[y,x]].values,range=((0,size_r),(0,size_c)),bins=(nr,nc))[0]
-    
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
-    """
-    The dataset could contain two channels (Zeiss data) in which case there will be a
-    column which indicates the channel number and the localisations in each channel are
-    stacked vertically in the file
-    
-    @param all_data: all the data read from the localisations file
-    @param col:      which coordinate column in all_data we are currently extracting
-    @param chan:     the channel we are currently extracting
-    @param chancol:  the column in all_data where we will find the channel assignment
-    """     
-
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
-        
-def get_all_locs(all_data,sizeC,file_type,nm_per_pixel):
-    """
-    Returns the xy coordinates from the input data in a numpy array
-    
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    @param pix_size: the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """    
-    if sizeC > 1:
-        chancol = file_type['chan_col']
-    else:
-        chancol = None
-    xcol = file_type['x_col']
-    ycol = file_type['y_col']
-    frame = file_type['frame']
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        inchan = get_all_locs_in_chan(all_data,c,chancol)
-        x = pd.DataFrame(inchan[xcol]*nm_per_pixel,columns=[xcol])
-        y = pd.DataFrame(inchan[ycol]*nm_per_pixel,columns=[ycol])
-        t = pd.DataFrame(inchan[frame],columns=[frame])
-        reduced = pd.concat([x,y,t],join='outer',axis=1)        
-        coords.append(reduced)   
-    return coords
-                    
-def parse_sr_data(path,file_type,pix_size=95):
-    """
-    Parses all the data in the file being processed,
-    and returns the xy coords in a numpy array
-    
-    @param path:      the path to the localisations file being read
-    @param file_type: what type of dataset are we dealing with (see FILE_TYPES global)
-    @param pix_size:  the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """
-    
-    header_row = file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type['name']:
-        sizeC = 2
-        chancol = file_type['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    if 'zeiss' in file_type['name']:
-        pix_size = 1
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False)  
-        if 'palmtracer' in file_type['name']:
-            data.columns = ['track','orig_time','X position (pixel)','Y position (pixel)',\
-                       'good','intensity','extra1','extra2','time']
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,file_type,pix_size)
-    return coords     
-
-def download_data(ann):
-    """
-    Downloads the specified file to and returns the path on the server
-    
-    @param ann: the file annotation we are downloading
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
-    
-def delete_downloaded_data(ann):
-    """
-    Deletes the specified file from its temporary location
-    
-    @param ann: the file annotation being deleted
-    """     
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    shutil.rmtree(PATH)
+    return histogramdd(np.column_stack((data[y],data[x])),range=((0,size_r),(0,size_c)),bins=(nr,nc))[0]
     
 def process_data(conn,image,file_type,file_id,coords,sr_pix_size,nm_per_pixel):
     """
@@ -273,18 +160,16 @@ def process_data(conn,image,file_type,file_id,coords,sr_pix_size,nm_per_pixel):
         num_frames = image.getSizeT()
     else:
         num_frames = image.getSizeZ()
-    if 'zeiss2chan2D' in file_type:
-        sizeC = 2
-    else:
-        sizeC = 1
+    sizeC = len(coords)
     rangex = frame_width * nm_per_pixel
     binsx = rangex / sr_pix_size
     rangey = frame_height * nm_per_pixel
     binsy = rangey / sr_pix_size
     hist_data = np.zeros((sizeC,binsy,binsx))
     for c in range(sizeC):
-        hist = calc_hist(coords[c],file_type,binsy,binsx,rangey,rangex)
-        hist_data[c,:,:] = hist
+        # bin a block of localisations at a time to bound memory
+        for chunk in iter_locs_chunks(coords[c]):
+            hist_data[c,:,:] += calc_hist(chunk,file_type,binsy,binsx,rangey,rangex)
         
     def plane_gen():
         for z in range(sizeZ):
@@ -311,7 +196,8 @@ def process_data(conn,image,file_type,file_id,coords,sr_pix_size,nm_per_pixel):
     pixels.setPhysicalSizeX( pixSize )
     pixels.setPhysicalSizeY( pixSize )
     
-    updateService.saveObject(pixels)    
+    # the pixels are saved in the same call as the dataset link
+    to_save = [pixels]
 
     if newImg:
         iid = newImg.getId()
@@ -329,11 +215,7 @@ def process_data(conn,image,file_type,file_id,coords,sr_pix_size,nm_per_pixel):
             print "No dataset created or found for new images."\
                 " Images will be orphans."
         else:
-            dsLink = omero.model.DatasetImageLinkI()
-            dsLink.parent = omero.model.DatasetI(
-                parentDataset.id.val, False)
-            dsLink.child = omero.model.ImageI(iid, False)
-            updateService.saveObject(dsLink)
+            to_save.extend(new_image_links(parentDataset.id.val,[iid]))
             if parentProject and parentProject.canLink():
                 # and put it in the   current project
                 projectLink = omero.model.ProjectDatasetLinkI()
@@ -342,6 +224,7 @@ def process_data(conn,image,file_type,file_id,coords,sr_pix_size,nm_per_pixel):
                 projectLink.child = omero.model.DatasetI(
                     dataset.id.val, False)
                 updateService.saveAndReturnObject(projectLink)   
+        save_in_batches(conn,to_save)
         message = 'Super resolution histogram successfully created'
     else:
         message = 'Something went wrong, could not make super resolution histogram'
@@ -390,10 +273,14 @@ def run_processing(conn,script_params):
     nm_per_pixel = physicalSizeX   
     print 'nm_per_pixel:',nm_per_pixel
     path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-    name,ext = os.path.splitext(path_to_ann)
+    name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
     if ('txt' in ext) or ('csv' in ext):
-        path_to_data = download_data(ann)
-        coords = parse_sr_data(path_to_data,file_type,nm_per_pixel)
+        filters = get_filters(script_params)
+        # Zeiss localisations are already in nm
+        pix_size = nm_per_pixel
+        if 'zeiss' in file_type['name']:
+            pix_size = 1
+        coords = get_localisations(ann,file_type,pix_size,filters)
         faMessage = process_data(conn,image,file_type,file_id,coords,sr_pix_size,nm_per_pixel)
 
     # clean up
@@ -434,6 +321,24 @@ def run_as_script():
     scripts.Int("Parent_Image_Pixel_Size", optional=True, grouping="06.2",
         description="Convert the localisation coordinates to nm (multiply by parent image pixel size)"),
         
+    scripts.Bool("Filter_Localisations", grouping="07", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="07.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="07.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="07.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="07.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="07.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
@@ -16,6 +16,8 @@ import pandas as pd
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import *
+from localisation_utils import (strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,get_locs_in_frames,iter_locs_chunks)
 import tempfile
 import glob
 import itertools
@@ -105,7 +107,6 @@ FILE_TYPES = {
                                  'chan_col': 'Channel'
                                  }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
 
 def calc_hist(data,file_type,nr,nc,size_r,size_c):
     """
@@ -121,7 +122,7 @@ def calc_hist(data,file_type,nr,nc,size_r,size_c):
 
     x = file_type['x_col']
     y = file_type['y_col']
-    return histogramdd(data.loc[:,[y,x]].values,range=((0,size_r),(0,size_c)),bins=(nr,nc))[0]
+    return histogramdd(np.column_stack((data[y],data[x])),range=((0,size_r),(0,size_c)),bins=(nr,nc))[0]
     
 def get_frame_indices(start,stop,duration,overlap):
     """
@@ -142,121 +143,6 @@ def get_frame_indices(start,stop,duration,overlap):
     stop_frames = [int(sf + duration - 1) for sf in start_frames]
     return start_frames,stop_frames, num_frames+1      
 
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
-    """
-    The dataset could contain two channels (Zeiss data) in which case there will be a
-    column which indicates the channel number and the localisations in each channel are
-    stacked vertically in the file
-    
-    @param all_data: all the data read from the localisations file
-    @param col:      which coordinate column in all_data we are currently extracting
-    @param chan:     the channel we are currently extracting
-    @param chancol:  the column in all_data where we will find the channel assignment
-    """     
-
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
-        
-def get_all_locs(all_data,sizeC,file_type,nm_per_pixel):
-    """
-    Returns the xy coordinates from the input data in a numpy array
-    
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    @param pix_size: the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """    
-    if sizeC > 1:
-        chancol = file_type['chan_col']
-    else:
-        chancol = None
-    xcol = file_type['x_col']
-    ycol = file_type['y_col']
-    frame = file_type['frame']
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        inchan = get_all_locs_in_chan(all_data,c,chancol)
-        x = pd.DataFrame(inchan[xcol]*nm_per_pixel,columns=[xcol])
-        y = pd.DataFrame(inchan[ycol]*nm_per_pixel,columns=[ycol])
-        t = pd.DataFrame(inchan[frame],columns=[frame])
-        reduced = pd.concat([x,y,t],join='outer',axis=1)        
-        coords.append(reduced)   
-    return coords
-                    
-def parse_sr_data(path,file_type,pix_size=95):
-    """
-    Parses all the data in the file being processed,
-    and returns the xy coords in a numpy array
-    
-    @param path:      the path to the localisations file being read
-    @param file_type: what type of dataset are we dealing with (see FILE_TYPES global)
-    @param pix_size:  the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """
-    
-    header_row = file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type['name']:
-        sizeC = 2
-        chancol = file_type['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    if 'zeiss' in file_type['name']:
-        pix_size = 1
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False)  
-        if 'palmtracer' in file_type['name']:
-            data.columns = ['track','orig_time','X position (pixel)','Y position (pixel)',\
-                       'good','intensity','extra1','extra2','time']
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,file_type,pix_size)
-    return coords      
-
-def download_data(ann):
-    """
-    Downloads the specified file to and returns the path on the server
-    
-    @param ann: the file annotation we are downloading
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
-    
-def delete_downloaded_data(ann):
-    """
-    Deletes the specified file from its temporary location
-    
-    @param ann: the file annotation being deleted
-    """     
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    shutil.rmtree(PATH)
-    
 def process_data(conn,image,file_type,ann_id,locs,nm_per_pixel,sr_pix_size,starts,stops,sizeT):   
     """
     Run the processing and upload the resultant image
@@ -290,10 +176,7 @@ def process_data(conn,image,file_type,ann_id,locs,nm_per_pixel,sr_pix_size,start
     frame = file_type['frame']
     print 'frame',frame    
     sizeZ = 1
-    if 'zeiss2chan2D' in file_type:
-        sizeC = 2
-    else:
-        sizeC = 1
+    sizeC = len(locs)
     
     #calculate histogram
     rangex = frame_width * nm_per_pixel
@@ -302,17 +185,19 @@ def process_data(conn,image,file_type,ann_id,locs,nm_per_pixel,sr_pix_size,start
     binsy = rangey / sr_pix_size
     hist_frames = []
     for c in range(sizeC):
-        locs_df = locs[c]
         for t in range(sizeT):
-            coords_in_frames = locs_df[(locs_df['time'] >= starts[t]) & (locs_df['time']<= stops[t])]
-            hist = calc_hist(coords_in_frames,file_type,binsy,binsx,rangey,rangex)
+            hist = np.zeros((binsy,binsx))
+            # each window is a slice of the frame-sorted localisations
+            coords_in_frames = get_locs_in_frames(locs[c],frame,starts[t],stops[t])
+            for chunk in iter_locs_chunks(coords_in_frames):
+                hist += calc_hist(chunk,file_type,binsy,binsx,rangey,rangex)
             hist_frames.append(hist)
         
     def plane_gen():
         for z in range(sizeZ):
             for c in range(sizeC):
                 for t in range(sizeT):
-                    plane = hist_frames[t]
+                    plane = hist_frames[c*sizeT + t]
                     yield plane    
                     
     description = "Created from image:\n  Name: %s\n  Annotation ID: %d\n Frame indices:\n Start:%s\n Stop:%s"\
@@ -398,7 +283,7 @@ def run_processing(conn,script_params):
         return message
     
     path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-    name,ext = os.path.splitext(path_to_ann)
+    name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
     
     # either get the pixel size in the raw data from the parent meta data or set it from the script
     if script_params['Set_Parent_Pixel_Size']:
@@ -449,12 +334,14 @@ def run_processing(conn,script_params):
     print 'starts,stops,sizeT,num_frames',starts,stops,sizeT,num_frames
     # now that the parameters are set try to do the processing
     if ('txt' in ext) or ('csv' in ext):
-        # download the data
-        path_to_data = download_data(ann)
-        
-        # parse it
+        # get the parsed localisations (cached between runs)
         file_type = FILE_TYPES[script_params['File_Type']]
-        locs = parse_sr_data(path_to_data,file_type,nm_per_pixel)
+        filters = get_filters(script_params)
+        # Zeiss localisations are already in nm
+        pix_size = nm_per_pixel
+        if 'zeiss' in file_type['name']:
+            pix_size = 1
+        locs = get_localisations(ann,file_type,pix_size,filters)
         
         # build the new image
         faMessage = process_data(conn,image,file_type,file_id,locs,nm_per_pixel,sr_pix_size,starts,stops,sizeT)
@@ -510,6 +397,24 @@ def run_as_script():
     scripts.Int("Overlap", optional=False, grouping="07.4",
         description="Number of frames to overlap for sliding average (referenced from frame start)",default="-1"),  
         
+    scripts.Bool("Filter_Localisations", grouping="08", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="08.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="08.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="08.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="08.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="08.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
@@ -5,6 +5,7 @@ import os
 import shutil
 import time
 import numpy
+import numpy as np
 import omero.scripts as scripts
 import omero.util.script_utils as script_util
 from omero.model import LengthI
@@ -16,6 +17,8 @@ import pandas as pd
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import *
+from localisation_utils import (strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,iter_locs_chunks)
 import tempfile
 import glob
 import itertools
@@ -47,7 +50,6 @@ FILE_TYPES = {
                                  'chan_col': 'Channel'
                                  }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
 
 def calc_hist(data,file_type,nr,nc,np,size_r,size_c,size_p):
     """
@@ -66,102 +68,7 @@ def calc_hist(data,file_type,nr,nc,np,size_r,size_c,size_p):
     x = file_type['x_col']
     y = file_type['y_col']
     z = file_type['z_col']
-    return histogramdd(data.loc[:,[y,x,z]].values,range=((0,size_r),(0,size_c),(0,size_p)),bins=(nr,nc,np))[0]
-    
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
-    """
-    The dataset could contain two channels (Zeiss data) in which case there will be a
-    column which indicates the channel number and the localisations in each channel are
-    stacked vertically in the file
-    
-    @param all_data: all the data read from the localisations file
-    @param col:      which coordinate column in all_data we are currently extracting
-    @param chan:     the channel we are currently extracting
-    @param chancol:  the column in all_data where we will find the channel assignment
-    """     
-
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
-        
-def get_all_locs(all_data,sizeC,chancol):
-    """
-    Returns the xy coordinates from the input data in a numpy array
-    
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    """    
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        coords.append(get_all_locs_in_chan(all_data,c,chancol))   
-    return coords
-                    
-def parse_sr_data(path,file_type):
-    """
-    Parses all the data in the file being processed,
-    and returns the xy coords in a numpy array
-    
-    @param path:      the path to the localisations file being read
-    @param file_type: what type of dataset are we dealing with (see FILE_TYPES global)
-    @param pix_size:  the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """
-    
-    header_row = file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type['name']:
-        sizeC = 2
-        chancol = file_type['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False)  
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,chancol)
-    return coords         
-
-def download_data(ann):
-    """
-    Downloads the specified file to and returns the path on the server
-    
-    @param ann: the file annotation we are downloading
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
-    
-def delete_downloaded_data(ann):
-    """
-    Deletes the specified file from its temporary location
-    
-    @param ann: the file annotation being deleted
-    """     
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    shutil.rmtree(PATH)
+    return histogramdd(numpy.column_stack((data[y],data[x],data[z])),range=((0,size_r),(0,size_c),(0,size_p)),bins=(nr,nc,np))[0]
     
 def process_data(conn,image,file_type,file_id,locs,sr_pix_size,srz_pix_size,z_range,nm_per_pixel):
     """
@@ -198,10 +105,7 @@ def process_data(conn,image,file_type,file_id,locs,sr_pix_size,srz_pix_size,z_ra
 
     stepZ = nm_per_pixel[2]
     print 'sizeZ,stepZ',sizeZ,stepZ
-    if 'zeiss2chan2D' in file_type:
-        sizeC = 2
-    else:
-        sizeC = 1
+    sizeC = len(locs)
     
     sizeT = 1    
     rangex = frame_width * nm_per_pixel[0]
@@ -214,8 +118,9 @@ def process_data(conn,image,file_type,file_id,locs,sr_pix_size,srz_pix_size,z_ra
     print 'sizeC,binsy,binsx,binsz',sizeC,binsy,binsx,binsz
     hist_data = numpy.zeros((sizeC,binsy,binsx,binsz))
     for c in range(sizeC):
-        hist = calc_hist(locs[c],file_type,binsy,binsx,binsz,rangey,rangex,rangez)
-        hist_data[c,:,:,:] = hist
+        # bin a block of localisations at a time to bound memory
+        for chunk in iter_locs_chunks(locs[c]):
+            hist_data[c,:,:,:] += calc_hist(chunk,file_type,binsy,binsx,binsz,rangey,rangex,rangez)
         
     def plane_gen():
         for z in range(binsz):
@@ -327,10 +232,10 @@ def run_processing(conn,script_params):
     nm_per_pixel = [physicalSizeX,physicalSizeY,physicalSizeZ]
     print 'nm_per_pixel',nm_per_pixel
     path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-    name,ext = os.path.splitext(path_to_ann)
+    name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
     if ('txt' in ext) or ('csv' in ext):
-        path_to_data = download_data(ann)
-        coords = parse_sr_data(path_to_data,file_type)
+        filters = get_filters(script_params)
+        coords = get_localisations(ann,file_type,1,filters)
         faMessage = process_data(conn,image,file_type,file_id,coords,sr_pix_size,srz_pix_size,z_range,nm_per_pixel)
 
     # clean up
@@ -381,6 +286,24 @@ Only Zeiss 3D data is supported (4um Z range).""",
 #     scripts.Int("Parent_Image_Z_Step", optional=True, grouping="07.3",
 #         description="If multiple z planes were recorded, what was the step size"),
                                     
+    scripts.Bool("Filter_Localisations", grouping="08", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="08.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="08.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="08.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="08.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="08.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
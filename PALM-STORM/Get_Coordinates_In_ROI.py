@@ -14,7 +14,11 @@ import pandas as pd
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import *
+from localisation_utils import (strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,get_frame_window,build_grid_index,
+                                get_rows_in_roi)
 import tempfile
+from collections import OrderedDict
 import glob
 import itertools
 
@@ -103,7 +107,6 @@ FILE_TYPES = {
                                  'chan_col': 'Channel'
                                  }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
 
 def get_rectangles(conn, imageId):
     """
@@ -155,99 +158,9 @@ def get_rectangles(conn, imageId):
 
     return rois
 
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
-
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
-    
-def get_all_locs(all_data,sizeC,file_type,nm_per_pixel):
-    """
-    Returns the xy coordinates from the input data in a numpy array
-    
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    @param pix_size: the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """    
-    if sizeC > 1:
-        chancol = file_type['chan_col']
-    else:
-        chancol = None
-    xcol = file_type['x_col']
-    ycol = file_type['y_col']
-    frame = file_type['frame']
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        inchan = get_all_locs_in_chan(all_data,c,chancol)
-        x = pd.DataFrame(inchan[xcol]*nm_per_pixel,columns=[xcol])
-        y = pd.DataFrame(inchan[ycol]*nm_per_pixel,columns=[ycol])
-        t = pd.DataFrame(inchan[frame],columns=[frame])
-        reduced = pd.concat([x,y,t],join='outer',axis=1)        
-        coords.append(reduced)   
-    return coords
-                    
-def parse_sr_data(path,file_type,pix_size=95):
+def get_coords_in_roi(all_coords,roi,file_type,index=None,frames=None):
     """
-        Parses all the data in the file being processed,
-        and returns the xy coords in a numpy array
-    """
-    working_file_type = FILE_TYPES[file_type]
-    header_row = working_file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type:
-        sizeC = 2
-        chancol = FILE_TYPES[file_type]['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False)  
-        if 'palmtracer' in working_file_type['name']:
-            data.columns = ['track','orig_time','X position (pixel)','Y position (pixel)',\
-                       'good','intensity','extra1','extra2','time']
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,working_file_type,pix_size)
-    return coords    
-
-def download_data(ann):
-    """
-        Downloads the specified file to and returns the path on the server
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
-    
-def delete_downloaded_data(ann):
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    shutil.rmtree(PATH)
-    
-def get_coords_in_roi(all_coords,roi,file_type):
-    """
-        Returns the xy coordinates of the rectangular roi being processed
+        Returns a dataframe of the localisations in the rectangular roi being processed
     """
     
     xstart = roi[0]
@@ -258,8 +171,13 @@ def get_coords_in_roi(all_coords,roi,file_type):
     print 'xstart,xstop,ystart,ystop:',xstart,xstop,ystart,ystop
     x = FILE_TYPES[file_type]['x_col']
     y = FILE_TYPES[file_type]['y_col']
-    return all_coords[(all_coords[x] > xstart) & (all_coords[x] < xstop)
-                      & (all_coords[y] > ystart) & (all_coords[y] < ystop)]
+    rows = get_rows_in_roi(all_coords,x,y,(xstart,xstop,ystart,ystop),index)
+    if frames is not None:
+        # rows are sorted and the window is a range of rows
+        lo,hi = get_frame_window(all_coords,FILE_TYPES[file_type]['frame'],frames[0],frames[1])
+        rows = rows[np.searchsorted(rows,lo):np.searchsorted(rows,hi)]
+    return pd.DataFrame(OrderedDict((col,values.take(rows)) for col,values in all_coords.items()),
+                        columns=list(all_coords.keys()))
     
 def process_data(conn,image,file_type,rectangles,coords):
     """
@@ -281,15 +199,18 @@ def process_data(conn,image,file_type,rectangles,coords):
             stops = [int(s) for s in stops.split(',')]
     else:
         starts = [1]
-        stops = [coords[0][frame].max]
+        stops = [coords[0][frame].max()]
         
+    # index each channel once for all the rois and time points
+    x = FILE_TYPES[file_type]['x_col']
+    y = FILE_TYPES[file_type]['y_col']
+    indices = [build_grid_index(locs_df,x,y) for locs_df in coords]
     def coord_gen():
         for rect in rectangles:       
             for c in range(len(coords)):
                 locs_df = coords[c]
                 for t in range(sizeT):
-                    coords_in_frames = locs_df[(locs_df[frame]>= starts[t]) & (locs_df[frame]<= stops[t])]
-                    yield get_coords_in_roi(coords_in_frames,rect[:-1],file_type)
+                    yield get_coords_in_roi(locs_df,rect[:-1],file_type,indices[c],(starts[t],stops[t]))
 
     coord_generator = coord_gen()
     for rect in rectangles:
@@ -332,14 +253,14 @@ def run_processing(conn,script_params):
     file_type = script_params['File_Type']
      
     path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-    name,ext = os.path.splitext(path_to_ann)
+    name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
     if ('txt' in ext) or ('csv' in ext):
-        path_to_data = download_data(ann)
-        coords = parse_sr_data(path_to_data,file_type,cam_pix_size)
+        filters = get_filters(script_params)
+        coords = get_localisations(ann,FILE_TYPES[file_type],cam_pix_size,filters)
         rectangles = get_rectangles(conn,image_id)
         faMessage = process_data(conn,image,file_type,rectangles,coords)
     else:
-        message = 'file annotation must be txt or csv'
+        message = 'file annotation must be txt or csv (optionally gz, bz2 or xz compressed)'
         return message
     # clean up
     delete_downloaded_data(ann)
@@ -377,6 +298,24 @@ resolved image. Do not use `Convert coordinates to nm` option on Zeiss data.""",
     scripts.Int("Parent_Image_Pixel_Size", grouping="05.1",
         description="Convert the localisation coordinates to nm (multiply by parent image pixel size)"),
         
+    scripts.Bool("Filter_Localisations", grouping="06", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="06.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="06.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="06.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="06.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="06.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
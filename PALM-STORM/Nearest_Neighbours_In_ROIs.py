@@ -7,14 +7,17 @@ import time
 import numpy as np
 from random import random
 import pandas as pd
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
 import tempfile
+from collections import OrderedDict
 
 import omero.scripts as scripts
 import omero.util.script_utils as script_util
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import *
+from localisation_utils import (strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,build_grid_index,get_rows_in_roi)
 from omero.util.temp_files import create_path,remove_path
 
 FILE_TYPES = {
@@ -102,14 +105,15 @@ FILE_TYPES = {
                                  'chan_col': 'Channel'
                                  }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
-
-def create_distance_matrix(pointsA,pointsB):   
-    return np.sort(cdist(np.array(pointsA),np.array(pointsB),'euclidean'))
 
 def nearest_neighbour(dataXY,col=1):
-    dist_mat = create_distance_matrix(dataXY,dataXY)
-    nnDist = dist_mat[:,col]
+    # col=1 is the first neighbour, col=0 the point itself. the kd-tree
+    # needs O(N) memory rather than the full distance matrix
+    if dataXY.shape[0] <= col:
+        return np.zeros(0)
+    tree = cKDTree(dataXY)
+    dist,idx = tree.query(dataXY,k=col+1)
+    nnDist = dist[:,col]
     return nnDist
 
 def get_rectangles(conn, imageId):
@@ -161,17 +165,9 @@ def get_rectangles(conn, imageId):
 
     return rois
 
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
-
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
-
-def get_coords_in_roi(all_coords,roi,file_type):
+def get_coords_in_roi(all_coords,roi,file_type,index=None):
     """
-        Returns the xy coordinates of the rectangular roi being processed
+        Returns a dataframe of the localisations in the rectangular roi being processed
     """
     
     xstart = roi[0]
@@ -182,91 +178,24 @@ def get_coords_in_roi(all_coords,roi,file_type):
     print 'xstart,xstop,ystart,ystop:',xstart,xstop,ystart,ystop
     x = file_type['x_col']
     y = file_type['y_col']
-    return all_coords[(all_coords[x] > xstart) & (all_coords[x] < xstop)
-                      & (all_coords[y] > ystart) & (all_coords[y] < ystop)]
+    rows = get_rows_in_roi(all_coords,x,y,(xstart,xstop,ystart,ystop),index)
+    return pd.DataFrame(OrderedDict((col,values.take(rows)) for col,values in all_coords.items()),
+                        columns=list(all_coords.keys()))
     
-def get_all_locs(all_data,sizeC,file_type,nm_per_pixel):
+def bucket_locs_in_rois(locs,rectangles,file_type):
     """
-    Returns the xy coordinates from the input data in a numpy array
+    Returns a dataframe of the localisations in each rectangular roi,
+    using a spatial index of the channel so each roi only looks at the
+    localisations in the grid cells it overlaps
     
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    @param pix_size: the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """    
-    if sizeC > 1:
-        chancol = file_type['chan_col']
-    else:
-        chancol = None
-    xcol = file_type['x_col']
-    ycol = file_type['y_col']
-    frame = file_type['frame']
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        inchan = get_all_locs_in_chan(all_data,c,chancol)
-        x = pd.DataFrame(inchan[xcol]*nm_per_pixel,columns=[xcol])
-        y = pd.DataFrame(inchan[ycol]*nm_per_pixel,columns=[ycol])
-        t = pd.DataFrame(inchan[frame],columns=[frame])
-        reduced = pd.concat([x,y,t],join='outer',axis=1)        
-        coords.append(reduced)   
-    return coords
-                    
-def parse_sr_data(path,file_type,pix_size=95):
-    """
-        Parses all the data in the file being processed,
-        and returns the xy coords in a numpy array
+    @param locs:        the localisation columns of one channel
+    @param rectangles:  the regions of interest
+    @param file_type:   the type of dataset we are working on
+                        (see FILE_TYPES dictionary)
     """
+    index = build_grid_index(locs,file_type['x_col'],file_type['y_col'])
+    return [get_coords_in_roi(locs,rect,file_type,index) for rect in rectangles]
 
-    header_row = file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type['name']:
-        sizeC = 2
-        chancol = file_type['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False)  
-        if 'palmtracer' in file_type['name']:
-            data.columns = ['track','orig_time','X position (pixel)','Y position (pixel)',\
-                       'good','intensity','extra1','extra2','time']
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,file_type,pix_size)
-    return coords     
-
-def download_data(ann):
-    """
-        Downloads the specified file to and returns the path on the server
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
-    
-def delete_downloaded_data(ann):
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    shutil.rmtree(PATH)
-    
 def put_data_in_table(conn, imageIds, roiIds, neighbours, histogram, bins):
     columns = [
 #         omero.grid.LongColumn('imageId', '', []),
@@ -333,8 +262,10 @@ def process_data(conn,image,file_type,sizeC,rectangles,locs):
     nn_hist_list = []
     for c in range(sizeC):
         nn_hist = np.zeros((dist_bins.shape[0]-1,num_rois))
+        # index the channel once and collect the localisations of every roi from it
+        locs_in_rois = bucket_locs_in_rois(locs[c],rectangles,file_type)
         for i,rect in enumerate(rectangles):
-            locs_df = get_coords_in_roi(locs[c],rect,file_type)
+            locs_df = locs_in_rois[i]
             print locs_df.head()
             nn = nearest_neighbour(locs_df.loc[:,[x,y]].values)
             hist,edges = np.histogram(nn,bins=dist_bins)
@@ -367,13 +298,11 @@ def run_processing(conn,script_params):
     file_type = FILE_TYPES[script_params['File_Type']]
      
     path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-    name,ext = os.path.splitext(path_to_ann)
+    name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
     if ('txt' in ext) or ('csv' in ext):
-        #get the path to the downloaded data
-        path_to_data = download_data(ann)
-        
         #get all the xy coords in that data
-        locs = parse_sr_data(path_to_data,file_type,cam_pix_size)
+        filters = get_filters(script_params)
+        locs = get_localisations(ann,file_type,cam_pix_size,filters)
         sizeC = len(locs)
         
         #get the rois to be processed
@@ -387,7 +316,7 @@ def run_processing(conn,script_params):
 #         put_data_in_table(conn,imageIds,rectIds,nn_data,nn_hist,bins)
         
         #write the data to a csv
-        file_name = "near_neighbours_" + ann.getFile().getName()[:-4] + '.csv'
+        file_name = "near_neighbours_" + os.path.splitext(strip_compressed_ext(ann.getFile().getName()))[0] + '.csv'
         with file(file_name, 'w') as outfile:
             outfile.write('# nearest neighbour data for %s channels and %s ROIs: \n' % (len(nn_hist), nn_hist[0].shape[1] ))
             for c, channel in enumerate(nn_hist):
@@ -408,7 +337,7 @@ def run_processing(conn,script_params):
         elif len(file_anns) > 1:
             faMessage = "Created %s csv (Excel) files" % len(file_anns)
     else:
-        message = 'file annotation must be txt or csv'
+        message = 'file annotation must be txt or csv (optionally gz, bz2 or xz compressed)'
         return message
     # clean up
     delete_downloaded_data(ann)
@@ -447,6 +376,24 @@ Do not use `Convert coordinates to nm` option on Zeiss data.""",
     scripts.Int("Parent_Image_Pixel_Size", grouping="05.1",
         description="Convert the localisation coordinates to nm (multiply by parent image pixel size)"),
         
+    scripts.Bool("Filter_Localisations", grouping="06", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="06.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="06.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="06.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="06.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="06.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
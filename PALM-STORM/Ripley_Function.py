@@ -5,8 +5,10 @@ import pandas as pd
 import os
 import re
 import time
-from pair_correlation import ripleykfunction
+from scipy.spatial import cKDTree
 import tempfile
+import multiprocessing
+from collections import OrderedDict, deque
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -19,6 +21,10 @@ from omero.gateway import BlitzGateway
 import omero
 import omero.util.script_utils as script_utils
 from omero.rtypes import *
+from localisation_utils import (PATH,strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,get_frame_window,build_grid_index,
+                                get_rows_in_roi)
+from save_utils import save_in_batches,new_image_links,new_file_annotation_link
 
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
@@ -110,7 +116,7 @@ FILE_TYPES = {
                                  'chan_col': 'Channel'
                                  }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
+PAIR_BLOCK = 5000000 # point pairs held in memory at a time by ripley_function
 ADMIN_EMAIL = 'admin@omerocloud.qbi.uq.edu.au'
 startTime = 0
 
@@ -253,127 +259,17 @@ def get_rectangles(conn, imageId):
 
     return rois
 
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
+def get_coords_in_roi(all_coords,roi,file_type,index=None,frames=None):
     """
-    Extracts localisation coordinates for the specified channel
+    Returns a dataframe of the localisations in the rectangular roi being processed
     
-    @param all_data:    the pandas dataframe containing all parsed data
-    @param chan:        the channel being extracted
-    @param chancol:     the column index which specfies the channel
-    """
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
-    
-def get_all_locs(all_data,sizeC,file_type,nm_per_pixel):
-    """
-    Returns the xy coordinates from the input data in a numpy array
-    
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    @param pix_size: the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """    
-    if sizeC > 1:
-        chancol = file_type['chan_col']
-    else:
-        chancol = None
-    xcol = file_type['x_col']
-    ycol = file_type['y_col']
-    frame = file_type['frame']
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        inchan = get_all_locs_in_chan(all_data,c,chancol)
-        x = pd.DataFrame(inchan[xcol]*nm_per_pixel,columns=[xcol])
-        y = pd.DataFrame(inchan[ycol]*nm_per_pixel,columns=[ycol])
-        t = pd.DataFrame(inchan[frame],columns=[frame])
-        reduced = pd.concat([x,y,t],join='outer',axis=1)        
-        coords.append(reduced)   
-    return coords
-                    
-def parse_sr_data(path,file_type,pix_size=95):
-    """
-    Parses all the data in the file being processed,
-    and returns the xy coords in a numpy array
-    
-    @param path:         the path of the localisations file being parsed
-    @param file_type:    the type of dataset we are working on
-                         (see FILE_TYPES dictionary)
-    @param pix_size:     used to convert localisation coordinates to nm
-                         (except for Zeiss files)
-    """
-    working_file_type = FILE_TYPES[file_type]
-    header_row = working_file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type:
-        sizeC = 2
-        chancol = FILE_TYPES[file_type]['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False) 
-        if 'palmtracer' in working_file_type['name']:
-            data.columns = ['track','orig_time','X position (pixel)','Y position (pixel)',\
-                       'good','intensity','extra1','extra2','time']         
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,working_file_type,pix_size)
-    return coords      
-
-def download_data(ann):
-    """
-    Downloads the specified file to and returns the path on the server
-    
-    @param ann:    the file annotation being downloaded
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
-    
-def delete_downloaded_data(ann):
-    """
-    Deletes the downloaded file annoation
-    
-    @param ann:    the file annotation
-    """
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    try:
-        os.remove(file_path)
-    except OSError:
-        pass
-    shutil.rmtree(PATH)
-    
-def get_coords_in_roi(all_coords,roi,file_type):
-    """
-    Returns the xy coordinates of the rectangular roi being processed
-    
-    @param all_coords:    the pandas dataframe holding all parsed data
+    @param all_coords:    the localisation columns of one channel
     @param roi:           the region of interest we are working on
     @param file_type:    the type of dataset we are working on
                          (see FILE_TYPES dictionary)    
+    @param index:         the spatial index of the channel (see build_grid_index)
+    @param frames:        the first and last frame (inclusive) to keep,
+                          None keeps every frame
     """
     xstart = roi[0]
     xstop = roi[0]+roi[2]
@@ -383,8 +279,13 @@ def get_coords_in_roi(all_coords,roi,file_type):
     print 'xstart,xstop,ystart,ystop:',xstart,xstop,ystart,ystop
     x = FILE_TYPES[file_type]['x_col']
     y = FILE_TYPES[file_type]['y_col']
-    return all_coords[(all_coords[x] > xstart) & (all_coords[x] < xstop)
-                      & (all_coords[y] > ystart) & (all_coords[y] < ystop)]
+    rows = get_rows_in_roi(all_coords,x,y,(xstart,xstop,ystart,ystop),index)
+    if frames is not None:
+        # rows are sorted and the window is a range of rows
+        lo,hi = get_frame_window(all_coords,FILE_TYPES[file_type]['frame'],frames[0],frames[1])
+        rows = rows[np.searchsorted(rows,lo):np.searchsorted(rows,hi)]
+    return pd.DataFrame(OrderedDict((col,values.take(rows)) for col,values in all_coords.items()),
+                        columns=list(all_coords.keys()))
     
 def upload_figure(conn, destination):
     """
@@ -416,8 +317,10 @@ def upload_figure(conn, destination):
     return newImg
 
 def create_containers(conn,parent_image,child_image):
-    
-    updateService = conn.getUpdateService()
+    """
+    Returns a new (unsaved) link of the child image to the dataset of the
+    parent image, or None if the parent is not in a dataset
+    """
     parentDataset = parent_image.getParent()
     parentProject = parentDataset.getParent()
          
@@ -426,11 +329,7 @@ def create_containers(conn,parent_image,child_image):
         print "No dataset created or found for new images."\
             " Images will be orphans."
     else:
-        dsLink = omero.model.DatasetImageLinkI()
-        dsLink.parent = omero.model.DatasetI(
-            parentDataset.getId(), False)
-        dsLink.child = omero.model.ImageI(child_image.getId(), False)
-        updateService.saveObject(dsLink)
+        link = new_image_links(parentDataset.getId(),[child_image.getId()])[0]
 #     if parentProject and parentProject.canLink():
 #         # and put it in the   current project
 #         projectLink = omero.model.ProjectDatasetLinkI()
@@ -439,23 +338,295 @@ def create_containers(conn,parent_image,child_image):
 #         projectLink.child = omero.model.DatasetI(
 #             parentDataset.getId(), False)
 #         updateService.saveAndReturnObject(projectLink) 
+    return link
         
 def attach_results(conn,ann,image,data,sizeC,sizeR):
     
-    file_name = "ripleyl_plot_" + ann.getFile().getName()[:-4] + '.csv' 
+    file_name = "ripleyl_plot_" + os.path.splitext(strip_compressed_ext(ann.getFile().getName()))[0] + '.csv' 
     with file(file_name, 'w') as outfile:
         outfile.write('# ripley data for %s channels and %s ROIs: \n' % (sizeC, sizeR ))
         data.to_csv(outfile,sep=',',float_format='%8.2f',index=False,encoding='utf-8')
     
     description = "Ripley L function data created from:\n  Image ID: %d Annotation_ID: %d"\
                     % (image.getId(),ann.getId())        
-    new_file_ann, faMessage = script_util.createLinkFileAnnotation(
-        conn, file_name, image, output="Ripley L Plot csv (Excel) file",
-        mimetype="text/csv", desc=description)     
-    return new_file_ann
+    return new_file_annotation_link(conn,file_name,image.getId(),
+                                    mimetype="text/csv",desc=description)
         
     
-def process_data(conn,image,file_type,sizeC,rectangles,coords,rmax):
+def pair_histogram(points,others,radii,box,tree=None):
+    """
+    Returns the translation corrected number of ordered pairs of a point
+    in points and a point in others binned by distance: bin i holds the
+    pairs further apart than radii[i-1] and up to radii[i]. When others is
+    points a point is not paired with itself
+    
+    @param points:    the xy coordinates of the first points of the pairs
+    @param others:    the xy coordinates of the second points of the pairs
+    @param radii:     the distance scales, in increasing order
+    @param box:       [xstart,xstop,ystart,ystop] of the region
+    @param tree:      KD-tree of others, built when not given
+    """
+    width = float(box[1] - box[0])
+    height = float(box[3] - box[2])
+    area = width*height
+    rmax = radii[-1]
+    hist = np.zeros(radii.shape[0] + 1)
+    N = points.shape[0]
+    if N == 0 or others.shape[0] == 0:
+        return hist
+    if tree is None:
+        tree = cKDTree(others)
+    same = points is others
+    # size the blocks of points so each block finds about PAIR_BLOCK pairs
+    expected = others.shape[0]/area*np.pi*rmax**2
+    block_size = max(int(PAIR_BLOCK/(1.0 + expected)),1)
+    for start in range(0,N,block_size):
+        block = cKDTree(points[start:start+block_size])
+        near = block.sparse_distance_matrix(tree,rmax,output_type='ndarray')
+        i = near['i'] + start
+        j = near['j']
+        v = near['v']
+        if same:
+            other = i != j
+            i = i[other]
+            j = j[other]
+            v = v[other]
+        dx = np.abs(points[i,0] - others[j,0])
+        dy = np.abs(points[i,1] - others[j,1])
+        weights = area/((width - dx)*(height - dy))
+        # a pair counts at every radius from its distance upwards
+        hist += np.bincount(np.searchsorted(radii,v),
+                            weights=weights,minlength=radii.shape[0]+1)
+    return hist
+
+def ripley_function(points,radii,box,edge_correction=True):
+    """
+    Returns Ripley's K function and L - r for the points in the
+    rectangular box at every radius. All the radii come from one pass
+    over the pairs of points closer than the largest radius
+    
+    @param points:           the xy coordinates of the points
+    @param radii:            the distance scales, in increasing order
+    @param box:              [xstart,xstop,ystart,ystop] of the region
+    @param edge_correction:  weight each pair by the area of the box over the
+                             area in which its displacement can be seen
+                             (translation correction)
+    """
+    radii = np.asarray(radii,dtype=np.float64)
+    points = np.asarray(points,dtype=np.float64)
+    N = points.shape[0]
+    width = float(box[1] - box[0])
+    height = float(box[3] - box[2])
+    area = width*height
+    if N < 2:
+        K = np.zeros(radii.shape[0])
+        return K,np.sqrt(K/np.pi) - radii
+    tree = cKDTree(points)
+    if not edge_correction:
+        # the dual-tree count includes every point paired with itself
+        pairs = tree.count_neighbors(tree,radii) - N
+    else:
+        pairs = np.cumsum(pair_histogram(points,points,radii,box,tree)[:-1])
+    K = area*pairs/(N*(N - 1.0))
+    return K,np.sqrt(K/np.pi) - radii
+
+def ripley_l(points,radii,box):
+    """
+    Returns L - r of the points in the box (see ripley_function)
+    
+    @param points:    the xy coordinates of the points
+    @param radii:     the distance scales, in increasing order
+    @param box:       [xstart,xstop,ystart,ystop] of the region
+    """
+    K,l = ripley_function(points,radii,box)
+    return l
+
+def ripley_windows(points,bounds,radii,box):
+    """
+    Returns L - r of the points in each frame window of a timelapse. The
+    points are sorted by frame and each window is a range of them. The
+    pair counts are carried from one window to the next, only the pairs of
+    the points leaving and entering the window are removed and added, so
+    overlapping sliding windows cost about as much as one pass over all the
+    pairs. A window that does not overlap the previous one is counted afresh
+    
+    @param points:    the xy coordinates of the points, sorted by frame
+    @param bounds:    the first and last (exclusive) point of each window,
+                      in increasing order
+    @param radii:     the distance scales, in increasing order
+    @param box:       [xstart,xstop,ystart,ystop] of the region
+    """
+    radii = np.asarray(radii,dtype=np.float64)
+    points = np.asarray(points,dtype=np.float64)
+    area = float(box[1] - box[0])*float(box[3] - box[2])
+    curves = []
+    hist = None
+    prev_lo = prev_hi = 0
+    for lo,hi in bounds:
+        changed = (lo - prev_lo) + (hi - prev_hi)
+        if hist is None or lo < prev_lo or hi < prev_hi or lo >= prev_hi or \
+           changed > hi - lo:
+            window = points[lo:hi]
+            hist = pair_histogram(window,window,radii,box)
+        else:
+            kept = points[lo:prev_hi]
+            leaving = points[prev_lo:lo]
+            entering = points[prev_hi:hi]
+            tree = cKDTree(kept)
+            # ordered pairs within a union of disjoint sets are the pairs
+            # within each set plus twice the pairs across them
+            hist -= pair_histogram(leaving,leaving,radii,box)
+            hist -= 2*pair_histogram(leaving,kept,radii,box,tree)
+            hist += pair_histogram(entering,entering,radii,box)
+            hist += 2*pair_histogram(entering,kept,radii,box,tree)
+        prev_lo,prev_hi = lo,hi
+        N = hi - lo
+        if N < 2:
+            K = np.zeros(radii.shape[0])
+        else:
+            # removing pairs can leave rounding error below zero
+            K = area*np.maximum(np.cumsum(hist[:-1]),0)/(N*(N - 1.0))
+        curves.append(np.sqrt(K/np.pi) - radii)
+    return curves
+
+def cross_ripley_windows(points,bounds,others,other_bounds,radii,box):
+    """
+    Returns the cross L - r of the points of one channel to the points of
+    another in each frame window of a timelapse. Every pair of a point of
+    each channel closer than the largest radius is found once, with the same
+    translation correction as the univariate function
+    
+    @param points:          the xy coordinates of the first channel, sorted by frame
+    @param bounds:          the first and last (exclusive) point of the first
+                            channel in each window
+    @param others:          the xy coordinates of the second channel, sorted by frame
+    @param other_bounds:    the first and last (exclusive) point of the second
+                            channel in each window
+    @param radii:           the distance scales, in increasing order
+    @param box:             [xstart,xstop,ystart,ystop] of the region
+    """
+    radii = np.asarray(radii,dtype=np.float64)
+    points = np.asarray(points,dtype=np.float64)
+    others = np.asarray(others,dtype=np.float64)
+    area = float(box[1] - box[0])*float(box[3] - box[2])
+    curves = []
+    for (lo,hi),(other_lo,other_hi) in zip(bounds,other_bounds):
+        N = hi - lo
+        M = other_hi - other_lo
+        if N == 0 or M == 0:
+            K = np.zeros(radii.shape[0])
+        else:
+            hist = pair_histogram(points[lo:hi],others[other_lo:other_hi],radii,box)
+            K = area*np.cumsum(hist[:-1])/(N*float(M))
+        curves.append(np.sqrt(K/np.pi) - radii)
+    return curves
+
+def simulate_csr(num_points,box,radii,seed):
+    """
+    Returns L - r of one pattern of complete spatial randomness with
+    num_points points in the box
+    
+    @param num_points:    the number of points in the pattern
+    @param box:           [xstart,xstop,ystart,ystop] of the region
+    @param radii:         the distance scales, in increasing order
+    @param seed:          list of integers seeding this simulation only, so
+                          the envelope does not depend on the number of workers
+    """
+    rng = np.random.RandomState(seed)
+    points = np.column_stack((rng.uniform(box[0],box[1],num_points),
+                              rng.uniform(box[2],box[3],num_points)))
+    return ripley_l(points,radii,box)
+
+def simulate_cross_csr(num_points,num_others,box,radii,seed):
+    """
+    Returns the cross L - r of two independent patterns of complete spatial
+    randomness with num_points and num_others points in the box
+    
+    @param num_points:    the number of points in the first pattern
+    @param num_others:    the number of points in the second pattern
+    @param box:           [xstart,xstop,ystart,ystop] of the region
+    @param radii:         the distance scales, in increasing order
+    @param seed:          list of integers seeding this simulation only
+    """
+    rng = np.random.RandomState(seed)
+    points = np.column_stack((rng.uniform(box[0],box[1],num_points),
+                              rng.uniform(box[2],box[3],num_points)))
+    others = np.column_stack((rng.uniform(box[0],box[1],num_others),
+                              rng.uniform(box[2],box[3],num_others)))
+    return cross_ripley_windows(points,[(0,num_points)],others,[(0,num_others)],radii,box)[0]
+
+def csr_envelope(curves):
+    """
+    Returns the minimum, maximum, 2.5% and 97.5% quantile of the L - r
+    curves of the simulated patterns of complete spatial randomness
+    
+    @param curves:    L - r of each simulation (see simulate_csr)
+    """
+    curves = np.array(curves)
+    low,high = np.percentile(curves,[2.5,97.5],axis=0)
+    return curves.min(axis=0),curves.max(axis=0),low,high
+
+def run_task(task):
+    """
+    Runs one unit of work in a worker process of the pool
+    
+    @param task:    (function,arguments) of the unit of work
+    """
+    func,args = task
+    return func(*args)
+
+def run_ordered(pool,tasks,max_pending=None):
+    """
+    Yields the result of every task in the order of the tasks, computed on
+    the pool. Only max_pending tasks (and their data) are in flight at a
+    time, so memory stays bounded however many tasks there are
+    
+    @param pool:           the multiprocessing pool
+    @param tasks:          iterable of (function,arguments) units of work
+    @param max_pending:    the number of tasks in flight, twice the number of
+                           cpus by default
+    """
+    if max_pending is None:
+        max_pending = 2 * multiprocessing.cpu_count()
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(run_task,(task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def ripley_table(curves,envelopes,done,roi_ids,radii,channels=None):
+    """
+    Returns the Ripley results as a long-format table with one row per
+    channel, roi, time point and radius. Only the time points computed
+    for each roi are kept
+    
+    @param curves:       L - r for each (channel,roi,time point,radius)
+    @param envelopes:    the min, max, 2.5% and 97.5% CSR envelope for
+                         each (channel,roi,time point,radius), or None
+    @param done:         True for each (channel,roi,time point) computed
+    @param roi_ids:      the id of each roi
+    @param radii:        the distance scales
+    @param channels:     the label of each channel, the channel index by default
+    """
+    c,r,t = np.nonzero(done)
+    nr = radii.shape[0]
+    table = OrderedDict()
+    if channels is None:
+        table['channel'] = np.repeat(c,nr)
+    else:
+        table['channel'] = np.repeat(np.asarray(channels,dtype=object)[c],nr)
+    table['roi'] = np.repeat(np.asarray(roi_ids)[r],nr)
+    table['timepoint'] = np.repeat(t,nr)
+    table['radius'] = np.tile(radii,c.shape[0])
+    table['Ripley L'] = curves[done].ravel()
+    if envelopes is not None:
+        for name,values in zip(['min','max','2.5%','97.5%'],envelopes):
+            table['CSR %s' % name] = values[done].ravel()
+    return pd.DataFrame(table,columns=list(table.keys()))
+
+def process_data(conn,image,file_type,sizeC,rectangles,coords,rmax,simulations=0,seed=0,cross=False):
     """
     Calculates the ripley l function for coordinates in user-defined 
     rectangular region of interest
@@ -466,6 +637,11 @@ def process_data(conn,image,file_type,sizeC,rectangles,coords,rmax):
     @param rectangles:    the regions of interest
     @param coords:        the localisation coordinates
     @param rmax:          maximum distance scale for Ripley calculation
+    @param simulations:   number of CSR patterns simulated for the envelope
+                          of each curve (0 for no envelope)
+    @param seed:          the random seed of the simulations
+    @param cross:         also calculate the cross l function of the first
+                          channel to the second
     
     """    
 
@@ -473,7 +649,6 @@ def process_data(conn,image,file_type,sizeC,rectangles,coords,rmax):
     y = FILE_TYPES[file_type]['y_col']
     f = FILE_TYPES[file_type]['frame']
     dist_scale = np.linspace(0,rmax,200)
-    ripley_list = []
     sizeT = image.getSizeT()
     if sizeT > 1:
         desc = image.getDescription()
@@ -487,7 +662,7 @@ def process_data(conn,image,file_type,sizeC,rectangles,coords,rmax):
             stops = [int(s) for s in stops.split(',')]
     else:
         starts = [1]
-        stops = [coords[0][f].max]
+        stops = [coords[0][f].max()]
     
     if sizeT > 10:
         # plot every 5th time point
@@ -495,37 +670,101 @@ def process_data(conn,image,file_type,sizeC,rectangles,coords,rmax):
     else:
         interval = sizeT
         
-    plt.figure() 
-    for c in range(sizeC):
+    cross = cross and sizeC == 2
+    channels = range(sizeC)
+    if cross:
+        # the cross function is stored as one more channel
+        channels.append('%s-%s' % (channels[0],channels[1]))
         
-        chan = np.ones(dist_scale.shape[0])*c
-        r_df = pd.DataFrame(chan,columns=['channel'])
-        r_df['radius'] = dist_scale
-        locs_df = coords[c]
-        legend = []
-        for t in range(sizeT):
-            conn.keepAlive()
-            coords_in_frames = locs_df[(locs_df[f]>= starts[t]) & (locs_df[f]<= stops[t])]
-            for rect in rectangles:
+    def cut_roi(c,index,rect):
+        locs = get_coords_in_roi(coords[c],rect,file_type,index,(min(starts),max(stops)))
+        frames = locs[f].values
+        bounds = [(np.searchsorted(frames,starts[t],'left'),
+                   np.searchsorted(frames,stops[t],'right'))
+                  for t in range(sizeT)]
+        return locs.loc[:,[x,y]].values,bounds
+        
+    # every channel and roi is a unit of work for the pool, followed by the
+    # csr simulations of each of its time points. the rois are cut out here
+    # while the workers run so only the units in flight are held in memory
+    units = deque()
+    def tasks():
+        indices = [build_grid_index(coords[c],x,y) for c in range(sizeC)]
+        for c in range(sizeC):
+            for r,rect in enumerate(rectangles):
                 rid = rect[-1]
-                locs = get_coords_in_roi(coords_in_frames,rect,file_type) 
-                if len(locs.index) > 0:      
+                points,bounds = cut_roi(c,indices[c],rect)
+                if points.shape[0] > 0:
                     box = [rect[0],rect[0]+rect[2],rect[1],rect[1]+rect[3]]
-                    s = time.time()
-                    l = ripleykfunction(locs.loc[:,[x,y]].values,dist_scale,box,0)
-                    print 'Ripley calculation took:', time.time() - s
-                    ripley_column = 'Ripley L ROI_%s_time0%s' % (rid,t)
-                    r_df[ripley_column] = l
-                    if t % interval == 0:
-                        s = time.time()
-                        plt.plot(r_df.loc[:,['radius']].values,r_df.loc[:,[ripley_column]])
-                        legend.append('ROI_%s_timepoint_%s'%(rid,t))
-                        print 'Ripley plot took:',time.time() - s
-            ripley_list.append(r_df)
+                    sizes = [(hi - lo,) for lo,hi in bounds]
+                    units.append((c,r,sizes))
+                    yield ripley_windows,(points,bounds,dist_scale,box)
+                    for t,(n,) in enumerate(sizes):
+                        if n > 0:
+                            for i in range(simulations):
+                                yield simulate_csr,(n,box,dist_scale,[seed,c,t,rid,i])
+        if cross:
+            c = sizeC
+            for r,rect in enumerate(rectangles):
+                rid = rect[-1]
+                points,bounds = cut_roi(0,indices[0],rect)
+                others,other_bounds = cut_roi(1,indices[1],rect)
+                if points.shape[0] > 0 and others.shape[0] > 0:
+                    box = [rect[0],rect[0]+rect[2],rect[1],rect[1]+rect[3]]
+                    sizes = [(hi - lo,other_hi - other_lo) for (lo,hi),(other_lo,other_hi)
+                             in zip(bounds,other_bounds)]
+                    units.append((c,r,sizes))
+                    yield cross_ripley_windows,(points,bounds,others,other_bounds,dist_scale,box)
+                    for t,(n,m) in enumerate(sizes):
+                        if n > 0 and m > 0:
+                            for i in range(simulations):
+                                yield simulate_cross_csr,(n,m,box,dist_scale,[seed,c,t,rid,i])
+                            
+    # the results are written in place, one curve per (channel,roi,time point)
+    shape = (len(channels),len(rectangles),sizeT)
+    curves = np.zeros(shape + dist_scale.shape)
+    done = np.zeros(shape,dtype=bool)
+    envelopes = None
+    if simulations > 0:
+        envelopes = np.zeros((4,) + shape + dist_scale.shape)
         
-    ripley_df = pd.concat(ripley_list).reset_index(drop=True)
+    pool = multiprocessing.Pool()
+    plt.figure() 
+    s = time.time()
+    try:
+        results = run_ordered(pool,tasks())
+        for windows in results:
+            conn.keepAlive()
+            c,r,sizes = units.popleft()
+            rid = rectangles[r][-1]
+            for t,l in enumerate(windows):
+                if min(sizes[t]) == 0:
+                    continue
+                curves[c,r,t] = l
+                done[c,r,t] = True
+                if simulations > 0:
+                    envelopes[:,c,r,t] = csr_envelope([next(results) for i in range(simulations)])
+                if t % interval == 0:
+                    # label each curve so the envelopes never take its legend entry
+                    if c < sizeC:
+                        label = 'ROI_%s_timepoint_%s'%(rid,t)
+                    else:
+                        label = 'ROI_%s_timepoint_%s_cross'%(rid,t)
+                    plt.plot(dist_scale,l,label=label)
+                    if simulations > 0:
+                        plt.fill_between(dist_scale,envelopes[2,c,r,t],envelopes[3,c,r,t],alpha=0.2,
+                                         label='%s CSR 95%%'%label)
+        pool.close()
+    except:
+        # do not leave workers behind in the script process
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print 'Ripley calculation took:', time.time() - s
+    ripley_df = ripley_table(curves,envelopes,done,[rect[-1] for rect in rectangles],dist_scale,channels)
     ripfig_path = os.path.join(PATH,'RipleyPlots')
-    plt.legend(legend)
+    plt.legend()
     plt.xlabel('Radius (nm)')
     plt.ylabel('L - r')
     plt.savefig(ripfig_path)
@@ -542,7 +781,6 @@ def run_processing(conn,script_params):
     dataType = script_params["Data_Type"]
     updateService = conn.getUpdateService()
     
-    file_anns = []
     message = ""
     
     if script_params['Convert_coordinates_to_nm']:
@@ -551,6 +789,9 @@ def run_processing(conn,script_params):
         cam_pix_size = 1
     file_type = script_params['File_Type']
     rmax = script_params['Max_radius']
+    simulations = script_params.get('CSR_Simulations',0)
+    seed = script_params.get('Random_Seed',0)
+    cross = script_params.get('Cross_Ripley',False)
     
     file_ids = script_params['AnnotationIDs']
 
@@ -574,16 +815,12 @@ def run_processing(conn,script_params):
         message += "No rectangle ROI found."
         return None, message
 
-    total_rois = sum([i.getROICount("Rect") for i in images])
-    if total_rois > 10:
-        message += "Cannot start batch processing - too many rois (maximum is 10)."
-        return None, message
-        
     image_ids = [i.getId() for i in images]
 
     ripley = []
     figures = []
     figure_ids = []
+    file_anns = []
     for i,id in enumerate(image_ids):
         image = conn.getObject("Image",id)
 
@@ -597,13 +834,11 @@ def run_processing(conn,script_params):
             return message
                 
         path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-        name,ext = os.path.splitext(path_to_ann)
+        name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
         if ('txt' in ext) or ('csv' in ext):
-            #download the localisations data file
-            path_to_data = download_data(ann)
-            
             #get all xy coords from the file
-            coords = parse_sr_data(path_to_data,file_type,cam_pix_size)
+            filters = get_filters(script_params)
+            coords = get_localisations(ann,FILE_TYPES[file_type],cam_pix_size,filters)
             
             #determine the number of channels
             sizeC = len(coords)
@@ -612,35 +847,38 @@ def run_processing(conn,script_params):
             rectangles = get_rectangles(conn,id)
             
             #calculate the ripley function in each roi
-            ripley_data,ripley_figure = process_data(conn,image,file_type,sizeC,rectangles,coords,rmax)
+            ripley_data,ripley_figure = process_data(conn,image,file_type,sizeC,rectangles,coords,rmax,
+                                                     simulations,seed,cross)
             ripley.append(ripley_data)
             figures.append(ripley_figure)
             figure_ids.append(ripley_figure.getId())
             
-            create_containers(conn,image,ripley_figure)
+            # the links and csv annotation of each image are saved together before
+            # the next file is processed, so a later failure does not orphan them
+            to_save = []
+            dsLink = create_containers(conn,image,ripley_figure)
+            if dsLink is not None:
+                to_save.append(dsLink)
                 
-            new_file_ann = attach_results(conn,ann,ripley_figure,ripley_data,sizeC,rectangles)
-            
-            if new_file_ann:
-                file_anns.append(new_file_ann)
-                
-            if not file_anns:
-                faMessage = "No Analysis files created. See 'Info' or 'Error' for"\
-                    " more details"
-            elif len(file_anns) > 1:
-                faMessage = "Created %s csv (Excel) files" % len(file_anns)
-            elif len(file_anns) == 1:
-                faMessage = "Created a new csv (Excel) file and attached to image ID %s" \
-                % ripley_figure.getId()
+            to_save.append(attach_results(conn,ann,ripley_figure,ripley_data,sizeC,len(rectangles)))
+            file_anns.append(save_in_batches(conn,to_save)[-1].child)
                 
             # clean up
             delete_downloaded_data(ann)
-            
-            message += faMessage
         else:
-            message = 'file annotation must be txt or csv'
+            message = 'file annotation must be txt or csv (optionally gz, bz2 or xz compressed)'
             return message
         
+    if not file_anns:
+        faMessage = "No Analysis files created. See 'Info' or 'Error' for"\
+            " more details"
+    elif len(file_anns) > 1:
+        faMessage = "Created %s csv (Excel) files" % len(file_anns)
+    elif len(file_anns) == 1:
+        faMessage = "Created a new csv (Excel) file and attached to image ID %s" \
+        % figure_ids[0]
+    message += faMessage
+        
     robj = (len(figures) > 0) and figures[0]._obj or None
     return robj, message    
 
@@ -679,6 +917,15 @@ Do not use `Convert coordinates to nm` option on Zeiss data""",
     scripts.Int("Max_radius", optional=False, grouping="06",
         description="Maximum distance scale for calculation (in nm)", default=1000),
         
+    scripts.Int("CSR_Simulations", optional=True, grouping="06.1", default=0,
+        description="Number of complete spatial randomness simulations for the L - r envelope (0 for none)"),
+        
+    scripts.Int("Random_Seed", optional=True, grouping="06.2", default=0,
+        description="Seed of the simulations, the same seed gives the same envelope"),
+        
+    scripts.Bool("Cross_Ripley", optional=True, grouping="06.3", default=False,
+        description="Also calculate the cross L - r function of channel 0 to channel 1 (two channel data)"),
+        
     scripts.Bool(
         "Email_Results", grouping="07", default=False,
         description="E-mail the results"),
@@ -686,6 +933,24 @@ Do not use `Convert coordinates to nm` option on Zeiss data""",
     scripts.String("Email_address", grouping="07.1",
     description="Specify e-mail address"), 
         
+    scripts.Bool("Filter_Localisations", grouping="08", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="08.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="08.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="08.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="08.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="08.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
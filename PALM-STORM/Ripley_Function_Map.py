@@ -2,21 +2,26 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import pandas as pd
-from scipy.interpolate import Rbf
-from scipy.spatial.distance import cdist
+from scipy.ndimage import gaussian_filter
+from scipy.spatial import cKDTree
 import os
 import shutil
 import re
 import time
 import math
-from pair_correlation import ripleykperpoint
+import multiprocessing
 import tempfile
+from collections import OrderedDict, deque
 
 import omero.scripts as scripts
 import omero.util.script_utils as script_util
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import *
+from localisation_utils import (strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,get_frame_window,count_locs,build_grid_index,
+                                get_rows_in_roi)
+from save_utils import save_in_batches,new_image_links,new_file_annotation_link
 
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
@@ -108,7 +113,10 @@ FILE_TYPES = {
                                  'chan_col': 'Channel'
                                  }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
+LOCAL_L_SPLIT = 100000 # points in a roi above which the per point L is split across processes
+PAIR_BLOCK = 5000000 # neighbour pairs found at a time by the per point L
+MAP_PIXEL = 50.0 # size (nm) of the pixels of the cluster maps
+FOV_TILE = 512 # pixels along the side of a tile of the field of view cluster map
 ADMIN_EMAIL = 'admin@omerocloud.qbi.uq.edu.au'
 startTime = 0
 
@@ -252,135 +260,347 @@ def get_rectangles(conn, imageId):
 
     return rois
 
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
+def get_coords_in_roi(all_coords,roi,file_type,index=None,frames=None):
     """
-    Extracts localisation coordinates for the specified channel
+    Returns a dataframe of the localisations in the rectangular roi being processed
     
-    @param all_data:    the pandas dataframe containing all parsed data
-    @param chan:        the channel being extracted
-    @param chancol:     the column index which specfies the channel
+    @param all_coords:    the localisation columns of one channel
+    @param roi:           the region of interest we are working on
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)    
+    @param index:         the spatial index of the channel (see build_grid_index)
+    @param frames:        the first and last frame (inclusive) to keep,
+                          None keeps every frame
     """
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
+    xstart = roi[0]
+    xstop = roi[0]+roi[2]
+    ystart = roi[1]
+    ystop = roi[1]+roi[3]
+    print 'roi:',roi
+    print 'xstart,xstop,ystart,ystop:',xstart,xstop,ystart,ystop
+    x = FILE_TYPES[file_type]['x_col']
+    y = FILE_TYPES[file_type]['y_col']
+    rows = get_rows_in_roi(all_coords,x,y,(xstart,xstop,ystart,ystop),index)
+    if frames is not None:
+        # rows are sorted and the window is a range of rows
+        lo,hi = get_frame_window(all_coords,FILE_TYPES[file_type]['frame'],frames[0],frames[1])
+        rows = rows[np.searchsorted(rows,lo):np.searchsorted(rows,hi)]
+    return pd.DataFrame(OrderedDict((col,values.take(rows)) for col,values in all_coords.items()),
+                        columns=list(all_coords.keys()))
     
-def get_all_locs(all_data,sizeC,file_type,nm_per_pixel):
+def disc_area_in_box(points,radius,box):
     """
-    Returns the xy coordinates from the input data in a numpy array
+    Returns the area of the disc of the radius around each point that lies
+    inside the box. The parts of the disc beyond each edge are removed and
+    the parts beyond two edges at a corner, removed twice, are added back
     
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    @param pix_size: the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """    
-    if sizeC > 1:
-        chancol = file_type['chan_col']
-    else:
-        chancol = None
-    xcol = file_type['x_col']
-    ycol = file_type['y_col']
-    frame = file_type['frame']
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        inchan = get_all_locs_in_chan(all_data,c,chancol)
-        x = pd.DataFrame(inchan[xcol]*nm_per_pixel,columns=[xcol])
-        y = pd.DataFrame(inchan[ycol]*nm_per_pixel,columns=[ycol])
-        t = pd.DataFrame(inchan[frame],columns=[frame])
-        reduced = pd.concat([x,y,t],join='outer',axis=1)        
-        coords.append(reduced)   
-    return coords
-                    
-def parse_sr_data(path,file_type,pix_size=95):
+    @param points:    the xy coordinates of the points
+    @param radius:    the radius of the discs
+    @param box:       [xstart,xstop,ystart,ystop] of the region
     """
-    Parses all the data in the file being processed,
-    and returns the xy coords in a numpy array
+    r = float(radius)
+    def segment(d):
+        # area of the disc beyond a line at distance d from the centre
+        d = np.clip(d,0,r)
+        return r*r*np.arccos(d/r) - d*np.sqrt(r*r - d*d)
+    def corner(dx,dy):
+        # area of the disc beyond lines at distances dx and dy from the centre
+        dx = np.clip(dx,0,r)
+        dy = np.clip(dy,0,r)
+        inside = dx*dx + dy*dy < r*r
+        top = np.sqrt(np.maximum(r*r - dy*dy,0))
+        def F(u):
+            return 0.5*(u*np.sqrt(np.maximum(r*r - u*u,0)) + r*r*np.arcsin(np.clip(u/r,-1,1)))
+        return np.where(inside,F(top) - F(dx) - dy*(top - dx),0.0)
+    left = points[:,0] - box[0]
+    right = box[1] - points[:,0]
+    bottom = points[:,1] - box[2]
+    top = box[3] - points[:,1]
+    area = np.pi*r*r - segment(left) - segment(right) - segment(bottom) - segment(top)
+    for dx in (left,right):
+        for dy in (bottom,top):
+            area += corner(dx,dy)
+    return area
+
+def local_l(points,core,radii,box,num_points):
+    """
+    Returns the local L function of each core point at each radius: the
+    edge corrected number of other points within the radius, as the radius
+    of the disc that would hold them at the mean density of the box. All
+    the radii come from one pass over the neighbours within the largest
     
-    @param path:         the path of the localisations file being parsed
-    @param file_type:    the type of dataset we are working on
-                         (see FILE_TYPES dictionary)
-    @param pix_size:     used to convert localisation coordinates to nm
-                         (except for Zeiss files)
+    @param points:        the xy coordinates of the points the core points
+                          are counted against
+    @param core:          the rows of points to return L for
+    @param radii:         the distance scales, in increasing order
+    @param box:           [xstart,xstop,ystart,ystop] of the region
+    @param num_points:    the number of points in the whole box
     """
-    working_file_type = FILE_TYPES[file_type]
-    header_row = working_file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type:
-        sizeC = 2
-        chancol = FILE_TYPES[file_type]['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False) 
-        if 'palmtracer' in working_file_type['name']:
-            data.columns = ['track','orig_time','X position (pixel)','Y position (pixel)',\
-                       'good','intensity','extra1','extra2','time']         
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,working_file_type,pix_size)
-    return coords      
-
-def download_data(ann):
+    radii = np.asarray(radii,dtype=np.float64)
+    nr = radii.shape[0]
+    area = float(box[1] - box[0])*float(box[3] - box[2])
+    centres = points[core]
+    counts = np.zeros((centres.shape[0],nr))
+    if num_points < 2 or centres.shape[0] == 0:
+        return counts
+    tree = cKDTree(points)
+    rmax = radii[-1]
+    # size the blocks of points so each block finds about PAIR_BLOCK pairs
+    expected = num_points/area*np.pi*rmax**2
+    block_size = max(int(PAIR_BLOCK/(1.0 + expected)),1)
+    for start in range(0,centres.shape[0],block_size):
+        block = cKDTree(centres[start:start+block_size])
+        near = block.sparse_distance_matrix(tree,rmax,output_type='ndarray')
+        n = min(block_size,centres.shape[0] - start)
+        # a neighbour counts at every radius from its distance upwards
+        binned = np.bincount(near['i']*nr + np.searchsorted(radii,near['v']),
+                             minlength=n*nr).reshape(n,nr)
+        counts[start:start+n] = np.cumsum(binned,axis=1)
+    # every point finds itself
+    counts -= 1
+    for k,r in enumerate(radii):
+        # weight each count by the disc over the part of it inside the box
+        counts[:,k] *= np.pi*r*r/disc_area_in_box(centres,r,box)
+    return np.sqrt(area*counts/(np.pi*(num_points - 1.0)))
+
+def run_task(task):
     """
-    Downloads the specified file to and returns the path on the server
+    Runs one unit of work in a worker process of the pool
     
-    @param ann:    the file annotation being downloaded
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
+    @param task:    (function,arguments) of the unit of work
+    """
+    func,args = task
+    return func(*args)
+
+def ripley_per_point(points,radii,box,pool=None):
+    """
+    Returns the local L function of every point in the box at each radius.
+    Large regions are cut in strips along x with the same number of points,
+    and each strip is counted in a worker process against its own points
+    and the points within the largest radius either side of it
     
-def delete_downloaded_data(ann):
+    @param points:    the xy coordinates of the points
+    @param radii:     the distance scales, in increasing order
+    @param box:       [xstart,xstop,ystart,ystop] of the region
+    @param pool:      the multiprocessing pool, None counts every point here
     """
-    Deletes the downloaded file annoation
+    points = np.asarray(points,dtype=np.float64)
+    N = points.shape[0]
+    if pool is None or N <= LOCAL_L_SPLIT:
+        return local_l(points,np.arange(N),radii,box,N)
+    rmax = radii[-1]
+    order = np.argsort(points[:,0],kind='mergesort')
+    points = points[order]
+    xs = points[:,0]
+    tasks = []
+    for core in np.array_split(np.arange(N),multiprocessing.cpu_count()):
+        if core.shape[0] == 0:
+            continue
+        lo = np.searchsorted(xs,xs[core[0]] - rmax,'left')
+        hi = np.searchsorted(xs,xs[core[-1]] + rmax,'right')
+        tasks.append((local_l,(points[lo:hi],core - lo,radii,box,N)))
+    l = np.empty((N,len(radii)))
+    l[order] = np.concatenate(pool.map(run_task,tasks))
+    return l
+
+def run_ordered(pool,tasks,max_pending=None):
+    """
+    Yields the result of every task in the order of the tasks, computed on
+    the pool. Only max_pending tasks (and their data) are in flight at a
+    time, so memory stays bounded however many tasks there are
     
-    @param ann:    the file annotation
+    @param pool:           the multiprocessing pool
+    @param tasks:          iterable of (function,arguments) units of work
+    @param max_pending:    the number of tasks in flight, twice the number of
+                           cpus by default
+    """
+    if max_pending is None:
+        max_pending = 2 * multiprocessing.cpu_count()
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(run_task,(task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def map_tile(points,core,radii,box,num_points,origin,shape,halo,method,sigma):
     """
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    shutil.rmtree(PATH)
+    Returns one tile of the field of view cluster map at each radius. The
+    local L of the points in the tile and the halo pixels around it is
+    computed against the points within the largest radius of them, gridded
+    over the tile and its halo so the gaussian reaches across the tile
+    edges, and cropped to the tile
     
-def get_coords_in_roi(all_coords,roi,file_type):
+    @param points:        the xy coordinates of the points in and near the tile
+    @param core:          the rows of points in the tile and its halo pixels
+    @param radii:         the distance scales, in increasing order
+    @param box:           [xstart,xstop,ystart,ystop] of the field of view
+    @param num_points:    the number of points in the field of view
+    @param origin:        the xy position (nm) of the corner of the tile
+    @param shape:         the number of pixels (rows,columns) of the tile
+    @param halo:          the number of pixels gridded around the tile
+    @param method:        'gaussian', 'mean' or 'max' (see grid_pixels)
+    @param sigma:         the width of the gaussian in pixels
+    """
+    ny,nx = shape[0] + 2*halo,shape[1] + 2*halo
+    l = local_l(points,core,radii,box,num_points)
+    cols = np.floor((points[core,0] - origin[0])/MAP_PIXEL).astype(np.intp) + halo
+    rows = np.floor((points[core,1] - origin[1])/MAP_PIXEL).astype(np.intp) + halo
+    inside = (cols >= 0) & (cols < nx) & (rows >= 0) & (rows < ny)
+    flat = rows[inside]*nx + cols[inside]
+    tiles = np.zeros((len(radii),) + tuple(shape),dtype=np.float32)
+    for k in range(len(radii)):
+        grid = grid_pixels(flat,l[inside,k],(ny,nx),method,sigma)
+        tiles[k] = grid[halo:halo+shape[0],halo:halo+shape[1]]
+    tiles[tiles<0.0] = 0.0
+    return tiles
+
+def process_fov(conn,script_params,image,file_type,sizeC,coords,radii,pool):
     """
-    Returns the xy coordinates of the rectangular roi being processed
+    Makes the cluster map of the whole field of view, with a channel for
+    each channel of the data at each radius. The map is cut in tiles of
+    FOV_TILE pixels computed on the pool, each from the points in and
+    around it only, and uploaded a tile at a time, so neither the workers
+    nor the upload hold more than a few tiles
     
-    @param all_coords:    the pandas dataframe holding all parsed data
-    @param roi:           the region of interest we are working on
-    @param file_type:    the type of dataset we are working on
-                         (see FILE_TYPES dictionary)    
+    @param conn:          the BlitzGateWay connection
+    @param script_params: the parameters collected from the script input
+    @param image:         the image being processed
+    @param file_type:     the type of dataset we are working on
+    @param sizeC:         number of channels in the image
+    @param coords:        the localisation coordinates
+    @param radii:         the distance scales, in increasing order
+    @param pool:          the multiprocessing pool
     """
-    xstart = roi[0]
-    xstop = roi[0]+roi[2]
-    ystart = roi[1]
-    ystop = roi[1]+roi[3]
-    print 'roi:',roi
-    print 'xstart,xstop,ystart,ystop:',xstart,xstop,ystart,ystop
     x = FILE_TYPES[file_type]['x_col']
     y = FILE_TYPES[file_type]['y_col']
-    return all_coords[(all_coords[x] > xstart) & (all_coords[x] < xstop)
-                      & (all_coords[y] > ystart) & (all_coords[y] < ystop)]
+    map_method = script_params.get('Map_Method','gaussian')
+    sigma = script_params.get('Map_Smoothing',50)/MAP_PIXEL
+    halo = int(np.ceil(4*sigma)) if map_method == 'gaussian' else 0
+    rmax = radii[-1]
+    nr = len(radii)
+    chans = [c for c in range(sizeC) if count_locs(coords[c]) > 0]
+    if not chans:
+        return None
+    box = [min(coords[c][x].min() for c in chans),max(coords[c][x].max() for c in chans),
+           min(coords[c][y].min() for c in chans),max(coords[c][y].max() for c in chans)]
+    sizeX = int((box[1] - box[0])//MAP_PIXEL) + 1
+    sizeY = int((box[3] - box[2])//MAP_PIXEL) + 1
+    print 'field of view map sizeX,sizeY:',sizeX,sizeY
+    
+    def tasks():
+        for c in range(sizeC):
+            locs = coords[c]
+            N = count_locs(locs)
+            if N == 0:
+                continue
+            index = build_grid_index(locs,x,y)
+            for ty in range(0,sizeY,FOV_TILE):
+                for tx in range(0,sizeX,FOV_TILE):
+                    h = min(FOV_TILE,sizeY - ty)
+                    w = min(FOV_TILE,sizeX - tx)
+                    origin = (box[0] + tx*MAP_PIXEL,box[2] + ty*MAP_PIXEL)
+                    # a pixel more than the halo so points on its edges are kept
+                    pad = (halo + 1)*MAP_PIXEL
+                    tile_box = [origin[0] - pad,origin[0] + w*MAP_PIXEL + pad,
+                                origin[1] - pad,origin[1] + h*MAP_PIXEL + pad]
+                    near = get_rows_in_roi(locs,x,y,[tile_box[0] - rmax,tile_box[1] + rmax,
+                                                     tile_box[2] - rmax,tile_box[3] + rmax],index)
+                    centres = get_rows_in_roi(locs,x,y,tile_box,index)
+                    points = np.column_stack((locs[x].take(near),locs[y].take(near))).astype(np.float64)
+                    core = np.searchsorted(near,centres)
+                    units.append((c,tx,ty,w,h))
+                    yield map_tile,(points,core,radii,box,N,origin,(h,w),halo,map_method,sigma)
+                    
+    pixelsService = conn.getPixelsService()
+    queryService = conn.getQueryService()
+    pixelsType = queryService.findByQuery(
+        "from PixelsType as p where p.value='float'", None)
+    imageName = 'Clusters_FOV_Image%s.ome.tif' % image.getId()
+    description = "Cluster map of the field of view of ImageID%s at radii %s nm" % (image.getId(),radii)
+    iId = pixelsService.createImage(sizeX,sizeY,1,1,range(sizeC*nr),pixelsType,
+                                    imageName,description,conn.SERVICE_OPTS)
+    newImg = conn.getObject("Image",iId)
+    pid = newImg.getPixelsId()
+    store = conn.c.sf.createRawPixelsStore()
+    store.setPixelsId(pid,True,conn.SERVICE_OPTS)
+    units = deque()
+    minmax = [[0.0,0.0] for c in range(sizeC*nr)]
+    try:
+        for tiles in run_ordered(pool,tasks()):
+            conn.keepAlive()
+            c,tx,ty,w,h = units.popleft()
+            for k,tile in enumerate(tiles):
+                # the channels are the radii of each channel of the data
+                theC = c*nr + k
+                minmax[theC][1] = max(minmax[theC][1],float(tile.max()))
+                # omero pixels are big-endian
+                store.setTile(tile.astype('>f4').tostring(),0,theC,0,tx,ty,w,h,conn.SERVICE_OPTS)
+        store.save(conn.SERVICE_OPTS)
+    finally:
+        store.close()
+    for theC in range(sizeC*nr):
+        pixelsService.setChannelGlobalMinMax(pid,theC,minmax[theC][0],minmax[theC][1],conn.SERVICE_OPTS)
+    return conn.getObject("Image",iId)
+
+def grid_values(xs,ys,values,box,shape,method='gaussian',sigma=1.0):
+    """
+    Returns a map of the per point values on a grid of shape pixels covering
+    the box, built in one pass over the points. Each point falls in the
+    pixel of the nearest grid node and the pixel holds the mean or maximum
+    of its points, or the gaussian weighted mean of the points around it
+    (the point sums and counts are smoothed and divided). Pixels without
+    points are zero
     
+    @param xs:        the x coordinates of the points
+    @param ys:        the y coordinates of the points
+    @param values:    the value of each point
+    @param box:       [xstart,xstop,ystart,ystop] of the region
+    @param shape:     the number of pixels (rows,columns) of the map
+    @param method:    'gaussian', 'mean' or 'max'
+    @param sigma:     the width of the gaussian in pixels
+    """
+    ny,nx = shape
+    def pixel(coords,start,stop,n):
+        if n < 2 or stop <= start:
+            return np.zeros(coords.shape[0],dtype=np.intp)
+        pos = np.rint((coords - start)*((n - 1)/float(stop - start)))
+        return np.clip(pos,0,n - 1).astype(np.intp)
+    xs = np.asarray(xs,dtype=np.float64).ravel()
+    ys = np.asarray(ys,dtype=np.float64).ravel()
+    values = np.asarray(values,dtype=np.float64).ravel()
+    flat = pixel(ys,box[2],box[3],ny)*nx + pixel(xs,box[0],box[1],nx)
+    return grid_pixels(flat,values,shape,method,sigma)
+
+def grid_pixels(flat,values,shape,method='gaussian',sigma=1.0):
+    """
+    Returns a map of the per point values from the flat pixel index of each
+    point (see grid_values)
+    
+    @param flat:      the flat (row * columns + column) pixel of each point
+    @param values:    the value of each point
+    @param shape:     the number of pixels (rows,columns) of the map
+    @param method:    'gaussian', 'mean' or 'max'
+    @param sigma:     the width of the gaussian in pixels
+    """
+    ny,nx = shape
+    if method == 'max':
+        grid = np.full(nx*ny,-np.inf)
+        np.maximum.at(grid,flat,values)
+        grid[np.isinf(grid)] = 0.0
+        return grid.reshape(shape)
+    sums = np.bincount(flat,weights=values,minlength=nx*ny).reshape(shape)
+    counts = np.bincount(flat,minlength=nx*ny).reshape(shape).astype(np.float64)
+    if method == 'gaussian':
+        sums = gaussian_filter(sums,sigma,mode='constant')
+        counts = gaussian_filter(counts,sigma,mode='constant')
+    grid = np.zeros(shape)
+    # far from any point the smoothed counts are only rounding error
+    filled = counts > 1e-6
+    grid[filled] = sums[filled]/counts[filled]
+    return grid
+
 def process_data(conn,script_params,image,file_type,sizeC,rectangles,coords,rmax):
     """
     Calculates the ripley l function for coordinates in user-defined 
@@ -414,65 +634,88 @@ def process_data(conn,script_params,image,file_type,sizeC,rectangles,coords,rmax
             stops = [int(s) for s in stops.split(',')]
     else:
         starts = [1]
-        stops = [coords[0][frame].max]
+        stops = [coords[0][frame].max()]
+    
+    map_method = script_params.get('Map_Method','gaussian')
+    map_sigma = script_params.get('Map_Smoothing',50)
+    # every radius is counted in the same pass as the largest
+    radii = sorted(set([rmax] + [r for r in script_params.get('Radii',[]) if r > 0]))
+    nr = len(radii)
     
     new_images = []  
     new_ids = []
-    for r,rect in enumerate(rectangles):
-        planes = []
-        ldf = []
-        for c in range(sizeC):
-            locs_df = coords[c]
-            tt = 0
-            for t in range(sizeT):
-                conn.keepAlive()
-                coords_in_frames = locs_df[(locs_df[frame]>= starts[t]) & (locs_df[frame]<= stops[t])]
-                locs = get_coords_in_roi(coords_in_frames,rect,file_type)       
-                box = [rect[0],rect[0]+rect[2],rect[1],rect[1]+rect[3]]
-                pixelsX = math.ceil(float(rect[2] / 50.0))
-                pixelsY = math.ceil(float(rect[3] / 50.0))
-                print 'pixelsX,pixelsY:',pixelsX,pixelsY
+    ann_links = []
+    pool = multiprocessing.Pool()
+    try:
+        # index each channel once for all the rois and time points
+        indices = [build_grid_index(coords[c],x,y) for c in range(sizeC)]
+        for r,rect in enumerate(rectangles):
+            planes = []
+            ldf = []
+            for c in range(sizeC):
+                locs_df = coords[c]
+                tt = 0
+                for t in range(sizeT):
+                    conn.keepAlive()
+                    locs = get_coords_in_roi(locs_df,rect,file_type,indices[c],(starts[t],stops[t]))
+                    box = [rect[0],rect[0]+rect[2],rect[1],rect[1]+rect[3]]
+                    pixelsX = int(math.ceil(float(rect[2] / MAP_PIXEL)))
+                    pixelsY = int(math.ceil(float(rect[3] / MAP_PIXEL)))
+                    print 'pixelsX,pixelsY:',pixelsX,pixelsY
                 
-                if len(locs.index)>0:
-                    l = ripleykperpoint(locs.loc[:,[x,y]].values,rmax,box,0)
-                    tx = np.linspace(box[0], box[1], pixelsX)
-                    ty = np.linspace(box[2], box[3], pixelsY)
-                    XI, YI = np.meshgrid(tx, ty)
-                    print 'num x vals,num y vals:',locs.loc[:,[x]].values.shape,locs.loc[:,[y]].values.shape
-                    rbf = Rbf(locs.loc[:,[x]].values, locs.loc[:,[y]].values, l, epsilon=2)
-                    ZI = rbf(XI, YI)
-                    ZI[ZI<0.0] = 0.0
-                else:
-                    ZI = np.zeros((pixelsY,pixelsX))
-                    l = np.zeros(100)
-                print 'ZI shape:',ZI.shape
-                planes.append(ZI)
-                ldf.append(pd.DataFrame(l))
+                    if len(locs.index)>0:
+                        l = ripley_per_point(locs.loc[:,[x,y]].values,radii,box,pool)
+                        print 'num x vals,num y vals:',locs.loc[:,[x]].values.shape,locs.loc[:,[y]].values.shape
+                        ZI = [grid_values(locs[x].values,locs[y].values,l[:,k],box,(pixelsY,pixelsX),
+                                          map_method,map_sigma/MAP_PIXEL) for k in range(nr)]
+                        for z in ZI:
+                            z[z<0.0] = 0.0
+                    else:
+                        ZI = [np.zeros((pixelsY,pixelsX)) for k in range(nr)]
+                        l = np.zeros((100,nr))
+                    print 'ZI shape:',ZI[0].shape
+                    planes.append(ZI)
+                    ldf.append(pd.DataFrame(l,columns=radii))
         
-        ripley_df = pd.concat(ldf,join='outer',axis=1)
+            ripley_df = pd.concat(ldf,join='outer',axis=1)
                         
-        def plane_gen():
-            for p in planes:
-                yield p  
+            def plane_gen():
+                # the channels are the radii of each channel of the data
+                for c in range(sizeC):
+                    for k in range(nr):
+                        for t in range(sizeT):
+                            yield planes[c*sizeT + t][k]
                         
-        imageName = 'Clusters_ROI_ID%s.ome.tif'%rect[-1]                
-        description = "Cluster map for ROI%s of ImageID%s" % (rect[-1],image.getId())
-        newImg = conn.createImageFromNumpySeq(
-            plane_gen(), imageName,
-            sizeZ=sizeZ, sizeC=sizeC, sizeT=sizeT,
-            description=description)        
+            imageName = 'Clusters_ROI_ID%s.ome.tif'%rect[-1]                
+            description = "Cluster map for ROI%s of ImageID%s at radii %s nm" % (rect[-1],image.getId(),radii)
+            newImg = conn.createImageFromNumpySeq(
+                plane_gen(), imageName,
+                sizeZ=sizeZ, sizeC=sizeC*nr, sizeT=sizeT,
+                description=description)        
         
-        new_images.append(newImg)
-        new_ids.append(newImg.getId())
+            new_images.append(newImg)
+            new_ids.append(newImg.getId())
          
-        file_name = "RLPP_ROI%s.csv" % (r)
-        with open(file_name,'w') as f:
-            f.write('# ripley per point data for %s channels and %s timepoints for ROI%s: \n' % (sizeC, sizeT, rect[-1]))
-            ripley_df.to_csv(f,sep=',',float_format='%8.2f',index=False,encoding='utf-8')
+            file_name = "RLPP_ROI%s.csv" % (r)
+            with open(file_name,'w') as f:
+                f.write('# ripley per point data for %s channels and %s timepoints for ROI%s: \n' % (sizeC, sizeT, rect[-1]))
+                ripley_df.to_csv(f,sep=',',float_format='%8.2f',index=False,encoding='utf-8')
     
-        new_file_ann, faMessage = script_util.createLinkFileAnnotation(
-            conn, file_name, newImg, output="wrote ripley per point data",
-            mimetype="text/csv", desc=None)
+            ann_links.append(new_file_annotation_link(conn,file_name,newImg.getId(),
+                                                      mimetype="text/csv"))
+        
+        if script_params.get('Whole_Field_Of_View',False):
+            newImg = process_fov(conn,script_params,image,file_type,sizeC,coords,radii,pool)
+            if newImg is not None:
+                new_images.append(newImg)
+                new_ids.append(newImg.getId())
+        pool.close()
+    except:
+        # do not leave workers behind in the script process
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
     if script_params['New_Dataset'] and \
        len(script_params['Container_Name'].strip()) > 0:
@@ -500,15 +743,11 @@ def process_data(conn,script_params,image,file_type,sizeC,rectangles,coords,rmax
         link = None
         print "No dataset created or found for new images."\
             " Images will be orphans."
+        save_in_batches(conn,ann_links)
     else:
-        link = []
-        for cid in new_ids:
-            dsLink = omero.model.DatasetImageLinkI()
-            dsLink.parent = omero.model.DatasetI(
-                parentDataset.id.val, False)
-            dsLink.child = omero.model.ImageI(cid, False)
-            updateService.saveObject(dsLink)
-            link.append(dsLink)
+        links = new_image_links(parentDataset.id.val,new_ids)
+        # the csv annotations are saved in the same calls as the links
+        link = save_in_batches(conn,links + ann_links)[:len(links)]
         if parentProject and parentProject.canLink():
             # and put it in the   current project
             projectLink = omero.model.ProjectDatasetLinkI()
@@ -554,20 +793,18 @@ def run_processing(conn,script_params):
             return message
                 
         path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-        name,ext = os.path.splitext(path_to_ann)
+        name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
         if ('txt' in ext) or ('csv' in ext):
-            #download the localisations data file
-            path_to_data = download_data(ann)
-            
             #get all xy coords from the file
-            coords = parse_sr_data(path_to_data,file_type,cam_pix_size)
+            filters = get_filters(script_params)
+            coords = get_localisations(ann,FILE_TYPES[file_type],cam_pix_size,filters)
             
             #determine the number of channels
             sizeC = len(coords)
             
             #get the regions of interest
             rectangles = get_rectangles(conn,id)
-            if rectangles:
+            if rectangles or script_params.get('Whole_Field_Of_View',False):
                 #calculate the ripley function in each roi
                 new_image, new_dataset, link, new_id = process_data(conn,script_params,image,file_type,sizeC,rectangles,coords,rmax)
                 if new_image is not None:
@@ -583,7 +820,7 @@ def run_processing(conn,script_params):
                     else:
                         links.append(link)
         else:
-            message = 'file annotation must be txt or csv'
+            message = 'file annotation must be txt or csv (optionally gz, bz2 or xz compressed)'
             return message
         # clean up
         delete_downloaded_data(ann)
@@ -616,6 +853,7 @@ def run_as_script():
     dataTypes = [rstring('Image')]
     
     fileTypes = [k for k in FILE_TYPES.iterkeys()]
+    mapMethods = [rstring('gaussian'),rstring('mean'),rstring('max')]
 
     client = scripts.client('Ripley_Lfunction.py', """This script calculates the Ripley L function for OMERO ROIs on a 
 reconstructed super resolution image at a specific distance scale set by the user (`Max radius`).
@@ -641,6 +879,19 @@ Do not use `Convert coordinates to nm` option on Zeiss data""",
         
     scripts.Int("Max_radius", optional=False, grouping="06",
         description="Maximum distance scale for calculation (in nm)", default=1000),
+        
+    scripts.String("Map_Method", optional=True, grouping="06.1",
+        description="How the L value of each localisation is put on the 50 nm pixels of the map: "\
+        "gaussian weighted mean, mean or maximum in each pixel", values=mapMethods, default="gaussian"),
+        
+    scripts.Float("Map_Smoothing", optional=True, grouping="06.2",
+        description="Width (sigma, in nm) of the gaussian of the gaussian map method", default=50.0),
+        
+    scripts.List("Radii", optional=True, grouping="06.4",
+        description="Further distance scales (in nm) mapped in the same pass, one channel each").ofType(rint(0)),
+        
+    scripts.Bool("Whole_Field_Of_View", optional=True, grouping="06.3", default=False,
+        description="Also map the whole field of view of the localisations, tile by tile, as one image"),
                             
     scripts.Bool(
         "New_Dataset", grouping="07", default=False,
@@ -656,6 +907,24 @@ Do not use `Convert coordinates to nm` option on Zeiss data""",
     scripts.String("Email_address", grouping="08.1",
     description="Specify e-mail address"), 
         
+    scripts.Bool("Filter_Localisations", grouping="09", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="09.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="09.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="09.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="09.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="09.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
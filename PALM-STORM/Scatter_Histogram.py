@@ -7,6 +7,7 @@ import time
 import numpy as np
 import pandas as pd
 import tempfile
+from collections import OrderedDict
 import itertools
 from math import ceil
 
@@ -15,6 +16,8 @@ import omero.util.script_utils as script_util
 from omero.gateway import BlitzGateway
 import omero
 from omero.rtypes import *
+from localisation_utils import (strip_compressed_ext,get_filters,get_localisations,
+                                delete_downloaded_data,build_grid_index,get_rows_in_roi)
 
 
 FILE_TYPES = {
@@ -76,7 +79,6 @@ FILE_TYPES = {
                                  'z_col': 'Position Z [nm]'
                                   }
 }
-PATH = tempfile.mkdtemp(prefix='downloads')
 
 def get_rectangles(conn, imageId):
     """
@@ -127,121 +129,14 @@ def get_rectangles(conn, imageId):
 
     return rois
 
-def get_all_locs_in_chan(all_data,chan=0,chancol=None):
+def get_coords_in_roi(all_coords,roi,file_type,index=None):
     """
-    The dataset could contain two channels (Zeiss data) in which case there will be a
-    column which indicates the channel number and the localisations in each channel are
-    stacked vertically in the file
-    
-    @param all_data: all the data read from the localisations file
-    @param col:      which coordinate column in all_data we are currently extracting
-    @param chan:     the channel we are currently extracting
-    @param chancol:  the column in all_data where we will find the channel assignment
-    """        
-
-    if chancol:
-        coords = all_data[all_data[chancol] == chan]
-    else:
-        coords = all_data
-    return coords
-    
-def get_all_locs(all_data,sizeC,file_type,nm_per_pixel):
-    """
-    Returns the xy coordinates from the input data in a numpy array
-    
-    @param all_data: all the data read from the localisations file
-    @param sizeC:    how many channels in the dataset
-    @param chancol:  which column in all_data where we will find the channel assignment
-    @param pix_size: the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """    
-    if sizeC > 1:
-        chancol = file_type['chan_col']
-    else:
-        chancol = None
-    xcol = file_type['x_col']
-    ycol = file_type['y_col']
-    frame = file_type['frame']
-    coords = [] 
-    print 'sizeC:',sizeC
-    for c in range(sizeC):
-        inchan = get_all_locs_in_chan(all_data,c,chancol)
-        x = pd.DataFrame(inchan[xcol]*nm_per_pixel,columns=[xcol])
-        y = pd.DataFrame(inchan[ycol]*nm_per_pixel,columns=[ycol])
-        t = pd.DataFrame(inchan[frame],columns=[frame])
-        reduced = pd.concat([x,y,t],join='outer',axis=1)        
-        coords.append(reduced)   
-    return coords
-                    
-def parse_sr_data(path,file_type,pix_size=95):
-    """
-    Parses all the data in the file being processed,
-    and returns the xy coords in a numpy array
-    
-    @param path:      the path to the localisations file being read
-    @param file_type: what type of dataset are we dealing with (see FILE_TYPES global)
-    @param pix_size:  the size of the pixel in the original data --> need for converting localisations
-                     to nm. defaults to 1 for Zeiss data which is already in nm
-    """
-    header_row = file_type['header_row']
-
-    if 'zeiss2chan2D' in file_type['name']:
-        sizeC = 2
-        chancol = file_type['chan_col']
-    else:
-        sizeC = 1
-        chancol = None   
-        
-    num_lines = sum(1 for line in open(path))
-    s = time.time()
-    try:
-        with open(path) as t_in:
-            data = pd.read_csv(t_in,header=header_row,\
-                               sep='\t',engine='c',\
-                               skiprows=range(num_lines-50,num_lines),\
-                               index_col=False,low_memory=False)  
-    except:
-        print 'there was a problem parsing localisation data'
-        return None
-    print 'reading the file took:',time.time()-s,'seconds'
-    coords = get_all_locs(data,sizeC,file_type,pix_size)
-    return coords        
-
-def download_data(ann):
-    """
-    Downloads the specified file to and returns the path on the server
-    
-    @param ann: the file annotation we are downloading
-    """ 
-    if not os.path.exists(PATH):
-        os.makedirs(PATH)
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    f = open(str(file_path), 'w')
-    print "\nDownloading file to", file_path, "..."
-    try:
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
-    finally:
-        f.close()
-        print "File downloaded!"
-    return file_path
-    
-def delete_downloaded_data(ann):
-    """
-    Deletes the specified file from its temporary location
-    
-    @param ann: the file annotation being deleted
-    """       
-    file_path = os.path.join(PATH, ann.getFile().getName())
-    shutil.rmtree(PATH)
-    
-def get_coords_in_roi(all_coords,roi,file_type):
-    """
-    Returns the xy coordinates of the rectangular roi being processed
+    Returns a dataframe of the localisations in the rectangular roi being processed
     
     @param all_coords: all xy and potentially z coordinates extracted from localisations file
     @param roi:        we are finding the coordinates inside this region
     @param file_type: what type of dataset are we dealing with (see FILE_TYPES global)    
+    @param index:      the spatial index of the channel (see build_grid_index)
     """
    
     xstart = roi[0]
@@ -250,9 +145,24 @@ def get_coords_in_roi(all_coords,roi,file_type):
     ystop = roi[1]+roi[3]
     x = file_type['x_col']
     y = file_type['y_col']
-    return all_coords[(all_coords[x] > xstart) & (all_coords[x] < xstop)
-                      & (all_coords[y] > ystart) & (all_coords[y] < ystop)]
+    rows = get_rows_in_roi(all_coords,x,y,(xstart,xstop,ystart,ystop),index)
+    return pd.DataFrame(OrderedDict((col,values.take(rows)) for col,values in all_coords.items()),
+                        columns=list(all_coords.keys()))
+    
+def bucket_locs_in_rois(locs,rectangles,file_type):
+    """
+    Returns a dataframe of the localisations in each rectangular roi,
+    using a spatial index of the channel so each roi only looks at the
+    localisations in the grid cells it overlaps
     
+    @param locs:        the localisation columns of one channel
+    @param rectangles:  the regions of interest
+    @param file_type:   the type of dataset we are working on
+                        (see FILE_TYPES dictionary)
+    """
+    index = build_grid_index(locs,file_type['x_col'],file_type['y_col'])
+    return [get_coords_in_roi(locs,rect,file_type,index) for rect in rectangles]
+
 def process_data(conn,image,file_type,rectangles,localisations,scalex,scaley,cIndex=0):
     """
     Get the coordinates in the ROI and form histograms of x and y coordinates
@@ -272,6 +182,8 @@ def process_data(conn,image,file_type,rectangles,localisations,scalex,scaley,cIn
     physY = pixels.getPhysicalSizeY()*1000.0
     x = file_type['x_col']
     y = file_type['y_col']
+    # index the channel once and collect the localisations of every roi from it
+    locs_in_rois = bucket_locs_in_rois(localisations[cIndex],rectangles,file_type)
     for i,rect in enumerate(rectangles):
         binsx = ceil((rect[2]/physX)/scalex)
         binsy = ceil((rect[3]/physY)/scaley)
@@ -280,7 +192,7 @@ def process_data(conn,image,file_type,rectangles,localisations,scalex,scaley,cIn
         rangey = rect[3]
         print 'rangex,rangey:',rangex,rangey
 
-        locs_df = get_coords_in_roi(localisations[cIndex],rect,file_type)
+        locs_df = locs_in_rois[i]
         histx,edgesx = np.histogram(locs_df.loc[:,[x]].values,bins=binsx)
         histy,edgesy = np.histogram(locs_df.loc[:,[y]].values,bins=binsy)
         hist_dataX = np.zeros((histx.shape[0],1))
@@ -344,14 +256,14 @@ def run_processing(conn,script_params):
     file_type = FILE_TYPES[script_params['File_Type']]
      
     path_to_ann = ann.getFile().getPath() + '/' + ann.getFile().getName()
-    name,ext = os.path.splitext(path_to_ann)
+    name,ext = os.path.splitext(strip_compressed_ext(path_to_ann))
     if ('txt' in ext) or ('csv' in ext):
-        path_to_data = download_data(ann)
-        coords = parse_sr_data(path_to_data,file_type,cam_pix_size)
+        filters = get_filters(script_params)
+        coords = get_localisations(ann,file_type,cam_pix_size,filters)
         rectangles = get_rectangles(conn,image_id)
         faMessage = process_data(conn,image,file_type,rectangles,coords,scalex,scaley)
     else:
-        message = 'file annotation must be txt or csv'
+        message = 'file annotation must be txt or csv (optionally gz, bz2 or xz compressed)'
         return message
     # clean up
     delete_downloaded_data(ann)
@@ -397,6 +309,24 @@ Do not convert Zeiss datasets to nm!""",
     scripts.Int("Scale_for_Y_bins", grouping="06.2", optional=False, default=2,
         description="Scale the histogram bins in the x-direction by a multiplication factor of the pixel size"), 
                                     
+    scripts.Bool("Filter_Localisations", grouping="07", default=False,
+        description="Discard localisations while the file is parsed"),
+
+    scripts.Float("Max_Precision", optional=True, grouping="07.1",
+        description="Discard localisations with a precision above this value"),
+
+    scripts.Float("Max_Z_Precision", optional=True, grouping="07.2",
+        description="Discard localisations with a z precision above this value (3D data)"),
+
+    scripts.Float("Min_Intensity", optional=True, grouping="07.3",
+        description="Discard localisations with an intensity (photons) below this value"),
+
+    scripts.Int("First_Frame", optional=True, grouping="07.4",
+        description="Discard localisations detected before this frame"),
+
+    scripts.Int("Last_Frame", optional=True, grouping="07.5",
+        description="Discard localisations detected after this frame"),
+
     authors = ["Daniel Matthews", "QBI"],
     institutions = ["University of Queensland"],
     contact = "d.matthews1@uq.edu.au",
@@ -0,0 +1,1026 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Localisation parsing, caching and download helpers shared by the PALM-STORM
+and Image_Processing scripts. OMERO runs each script from a temporary copy
+so this module has to be installed on the server's python path (see
+server_modules/README)
+"""
+import numpy as np
+import pandas as pd
+import os
+import re
+import time
+import tempfile
+import hashlib
+import json
+import Queue
+import threading
+import zlib
+import bz2
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz compressed localisations need backports.lzma on python 2
+        lzma = None
+from collections import OrderedDict
+import shutil
+
+PATH = tempfile.mkdtemp(prefix='downloads')
+FOOTER_LINES = 50
+CHUNK_ROWS = 1000000 # localisations parsed or processed at a time
+PIPE_CHUNKS = 8 # downloaded chunks buffered ahead of the parser
+# the cache locations and budgets can be set for the whole server through the
+# environment of the OMERO processes (see PALM-STORM/README)
+CACHE_PATH = os.environ.get('OMERO_LOCALISATION_CACHE',
+                            os.path.join(tempfile.gettempdir(),'omero_localisations_cache'))
+CACHE_SIZE = int(os.environ.get('OMERO_LOCALISATION_CACHE_SIZE',20 * 1024**3)) # bytes of parsed localisations kept between runs
+CACHE_FORMAT = 2 # changed whenever the layout of the cached localisations changes
+DOWNLOAD_CACHE_PATH = os.environ.get('OMERO_DOWNLOAD_CACHE',
+                                     os.path.join(tempfile.gettempdir(),'omero_download_cache'))
+DOWNLOAD_CACHE_SIZE = int(os.environ.get('OMERO_DOWNLOAD_CACHE_SIZE',50 * 1024**3)) # bytes of downloaded files shared between runs and users
+STALE_AGE = 24 * 3600 # seconds after which an unfinished cache entry was left by a killed script
+COMPRESSED_EXTS = {'.gz':'gzip','.bz2':'bz2','.xz':'xz'}
+GRID_CELLS = 1024 # cells along the longer side of the spatial index grid
+
+def get_chan_slices(chans,sizeC):
+    """
+    The dataset could contain two channels (Zeiss data) in which case there will be a
+    column which indicates the channel number and the localisations in each channel are
+    normally stacked vertically in the file. Returns the row order which groups the
+    localisations by channel (None when they are already grouped) and the slice of the
+    rows of each channel in that order. The sort is stable so each channel keeps the
+    order of the file
+    
+    @param chans:    the channel of each localisation
+    @param sizeC:    how many channels in the dataset
+    """
+    order = None
+    if (chans[1:] < chans[:-1]).any():
+        order = np.argsort(chans,kind='mergesort')
+        chans = chans.take(order)
+    starts = np.searchsorted(chans,np.arange(sizeC),side='left')
+    stops = np.searchsorted(chans,np.arange(sizeC),side='right')
+    return order,[slice(start,stop) for start,stop in zip(starts,stops)]
+    
+def get_all_locs(all_data,sizeC,file_type,nm_per_pixel,rows=None):
+    """
+    Returns the xy (and z for 3D data) coordinates and frame of each
+    localisation as an ordered dictionary of column arrays per channel.
+    The channels are split in one pass and share the column arrays
+    
+    @param all_data:     all the data read from the localisations file
+    @param sizeC:        how many channels in the dataset
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param nm_per_pixel: the size of the pixel in the original data --> need for converting localisations
+                         to nm. defaults to 1 for Zeiss data which is already in nm
+    @param rows:         the rows of all_data to keep (see filter_rows),
+                         None keeps every row
+    """    
+    xcol = file_type['x_col']
+    ycol = file_type['y_col']
+    zcol = file_type['z_col']
+    frame = file_type['frame']
+    if sizeC > 1:
+        chans = all_data[file_type['chan_col']].values
+        if rows is not None:
+            chans = chans.take(rows)
+        order,slices = get_chan_slices(chans,sizeC)
+        if order is not None:
+            rows = order if rows is None else rows.take(order)
+    else:
+        slices = [slice(None)]
+    columns = OrderedDict()
+    for col in [xcol,ycol,zcol,frame]:
+        if not col:
+            continue
+        values = all_data[col].values
+        if rows is not None:
+            values = values.take(rows)
+        if col in (xcol,ycol) and nm_per_pixel != 1:
+            values = values * nm_per_pixel
+        columns[col] = values
+    return [OrderedDict((col,values[s]) for col,values in columns.items())
+            for s in slices]
+
+class LocalisationBody(object):
+    """
+    A read-only file object over the body of a localisations file which
+    stops at the start of the footer, so the parser never sees the footer
+    
+    @param path: the path of the localisations file
+    @param stop: the byte offset at which the footer starts
+    """
+    def __init__(self,path,stop):
+        self._file = open(path,'rb')
+        self._remaining = stop
+        
+    def read(self,size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        chunk = self._file.read(size)
+        self._remaining -= len(chunk)
+        return chunk
+    
+    def readline(self,size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        line = self._file.readline(size)
+        self._remaining -= len(line)
+        return line
+    
+    def __iter__(self):
+        return iter(self.readline,b'')
+    
+    def close(self):
+        self._file.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+        
+def find_footer_offset(path,footer_lines=FOOTER_LINES,block_size=1<<16):
+    """
+    Returns the byte offset of the first footer line by reading backwards
+    from the end of the file, so the file does not have to be read twice
+    
+    @param path:         the path of the localisations file
+    @param footer_lines: the number of lines at the end of the file to skip
+    @param block_size:   the number of bytes read per step from the end
+    """
+    with open(path,'rb') as f:
+        f.seek(0,os.SEEK_END)
+        pos = f.tell()
+        if footer_lines <= 0:
+            return pos
+        # a newline at the very end of the file does not start another line
+        if pos > 0:
+            f.seek(pos-1)
+            if f.read(1) == b'\n':
+                pos -= 1
+        remaining = footer_lines
+        while pos > 0:
+            step = min(block_size,pos)
+            pos -= step
+            f.seek(pos)
+            block = f.read(step)
+            idx = len(block)
+            while True:
+                idx = block.rfind(b'\n',0,idx)
+                if idx < 0:
+                    break
+                remaining -= 1
+                if remaining == 0:
+                    return pos + idx + 1
+    return 0
+    
+def find_newline_from_end(buf,count):
+    """
+    Returns the index of the count-th newline from the end of buf,
+    or -1 if buf holds fewer newlines
+    
+    @param buf:     the bytes being searched
+    @param count:   which newline from the end to find
+    """
+    idx = len(buf)
+    for i in range(count):
+        idx = buf.rfind(b'\n',0,idx)
+        if idx < 0:
+            return -1
+    return idx
+
+class DownloadPipe(object):
+    """
+    A read-only file object over the body of a localisations file while it
+    is still being downloaded. A download thread feeds the chunks through a
+    bounded queue so parsing overlaps the transfer. The last footer_lines
+    lines are held back and dropped once the download has finished
+    
+    @param chunks:       iterable of the downloaded chunks of the file
+    @param footer_lines: the number of lines at the end of the file to skip
+    @param max_chunks:   the number of chunks buffered ahead of the parser
+    """
+    def __init__(self,chunks,footer_lines=FOOTER_LINES,max_chunks=PIPE_CHUNKS):
+        self._queue = Queue.Queue(max_chunks)
+        self._footer_lines = footer_lines
+        self._buffer = b''
+        self._safe = 0
+        self._done = False
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._download,args=(chunks,))
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def _put(self,chunk):
+        while not self._closed:
+            try:
+                self._queue.put(chunk,timeout=1)
+                return
+            except Queue.Full:
+                continue
+        
+    def _download(self,chunks):
+        try:
+            for chunk in chunks:
+                if self._closed:
+                    break
+                self._put(chunk)
+        except Exception as e:
+            self._error = e
+        self._put(None)
+        
+    def _fill(self):
+        chunk = self._queue.get()
+        if chunk is None:
+            self._done = True
+            if self._error is not None:
+                raise IOError('download failed: %s' % self._error)
+            end = len(self._buffer)
+            if self._footer_lines > 0:
+                # a newline at the very end of the file does not start another line
+                if self._buffer.endswith(b'\n'):
+                    end -= 1
+                end = find_newline_from_end(self._buffer[:end],self._footer_lines) + 1
+            self._buffer = self._buffer[:end]
+            self._safe = end
+            return
+        self._buffer += chunk
+        # everything before the last footer_lines+1 newlines is body
+        self._safe = max(find_newline_from_end(self._buffer,self._footer_lines+1),0)
+        
+    def read(self,size=-1):
+        while not self._done and self._safe == 0:
+            self._fill()
+        if size is None or size < 0 or size > self._safe:
+            size = self._safe
+        chunk = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._safe -= size
+        return chunk
+    
+    def readline(self,size=-1):
+        while not self._done and self._buffer.find(b'\n',0,self._safe) < 0:
+            self._fill()
+        end = self._buffer.find(b'\n',0,self._safe) + 1 or self._safe
+        if size is not None and 0 <= size < end:
+            end = size
+        return self.read(end)
+    
+    def __iter__(self):
+        return iter(self.readline,b'')
+    
+    def close(self):
+        self._closed = True
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+        
+def get_compression(file_name):
+    """
+    Returns the compression of a localisations file from its extension,
+    or None if the file is not compressed (or lzma is not available
+    to read xz files)
+    
+    @param file_name:    the name of the localisations file
+    """
+    compression = COMPRESSED_EXTS.get(os.path.splitext(file_name)[1].lower())
+    if compression == 'xz' and lzma is None:
+        return None
+    return compression
+
+def strip_compressed_ext(file_name):
+    """
+    Returns the file name without its compression extension
+    
+    @param file_name:    the name of the localisations file
+    """
+    if get_compression(file_name) is None:
+        return file_name
+    return os.path.splitext(file_name)[0]
+
+def get_decompressor(compression):
+    """
+    Returns a new incremental decompressor
+    
+    @param compression:    one of the values of COMPRESSED_EXTS
+    """
+    if compression == 'gzip':
+        # expect a gzip header rather than a raw zlib stream
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+def iter_decompressed(chunks,compression):
+    """
+    Yields the decompressed data of a compressed file as its chunks arrive,
+    so no decompressed copy of the file is written to disk. Concatenated
+    streams (as written by pigz or pbzip2) are decompressed in turn
+    
+    @param chunks:         iterable of the chunks of the compressed file
+    @param compression:    one of the values of COMPRESSED_EXTS
+    """
+    decompressor = get_decompressor(compression)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            # only set once the end of a stream has been reached
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = get_decompressor(compression)
+    if compression == 'gzip':
+        data = decompressor.flush()
+        if data:
+            yield data
+
+def iter_file_chunks(path,block_size=1<<20):
+    """
+    Yields the contents of a file in blocks
+    
+    @param path:          the path of the file
+    @param block_size:    the number of bytes read at a time
+    """
+    with open(path,'rb') as f:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                return
+            yield chunk
+
+def open_localisations(path,compression=None):
+    """
+    Returns a file object over the body of a localisations file on disk.
+    Compressed files are decompressed while they are read
+    
+    @param path:           the path of the localisations file
+    @param compression:    the compression of the file (see get_compression)
+    """
+    if compression is None:
+        return LocalisationBody(path,find_footer_offset(path))
+    return DownloadPipe(iter_decompressed(iter_file_chunks(path),compression))
+
+def get_parse_columns(file_type,filters=None):
+    """
+    Returns the names and types of the columns of the localisations file
+    used by the analyses and filters. No other column is parsed, coordinates
+    and filtered values are read as float32. Frames and channels are read as
+    float64, since some software writes them as decimals (12.0) or leaves
+    them blank, and are cast to int32 once parsed (see get_int_columns)
+    
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param filters:      the localisation filters (see get_filters)
+    """
+    dtypes = OrderedDict()
+    dtypes[file_type['x_col']] = np.float32
+    dtypes[file_type['y_col']] = np.float32
+    if file_type['z_col']:
+        dtypes[file_type['z_col']] = np.float32
+    for col in get_int_columns(file_type):
+        dtypes[col] = np.float64
+    for col in get_filter_columns(file_type,filters):
+        if col not in dtypes:
+            dtypes[col] = np.float32
+    return dtypes
+
+def get_int_columns(file_type):
+    """
+    Returns the names of the integer columns of the localisations file,
+    the frame and (for two channel data) the channel
+    
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    """
+    cols = [file_type['frame']]
+    if 'chan_col' in file_type:
+        cols.append(file_type['chan_col'])
+    return cols
+
+def get_filters(script_params):
+    """
+    Returns the localisation filters chosen in the script parameters
+    as a dictionary of the thresholds which have been set
+    
+    @param script_params:    the parameters passed to the script
+    """
+    filters = {}
+    if script_params.get('Filter_Localisations'):
+        for name in ['Max_Precision','Max_Z_Precision','Min_Intensity',
+                     'First_Frame','Last_Frame']:
+            if script_params.get(name) is not None:
+                filters[name] = script_params[name]
+    return filters
+
+def get_filter_columns(file_type,filters):
+    """
+    Returns the columns of the localisations file needed by the filters.
+    Filters on a column the file type does not have are ignored
+    
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param filters:      the localisation filters (see get_filters)
+    """
+    if not filters:
+        return []
+    columns = []
+    for name,col in [('Max_Precision',file_type.get('precision')),
+                     ('Max_Z_Precision',file_type.get('zprecision')),
+                     ('Min_Intensity',file_type.get('intensity'))]:
+        if name in filters and col:
+            columns.append(col)
+    if 'First_Frame' in filters or 'Last_Frame' in filters:
+        columns.append(file_type['frame'])
+    return columns
+
+def filter_rows(data,file_type,filters):
+    """
+    Returns the rows of a parsed block which pass the filters,
+    or None if no filter applies
+    
+    @param data:         a block of rows from the localisations file
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param filters:      the localisation filters (see get_filters)
+    """
+    if not get_filter_columns(file_type,filters):
+        return None
+    keep = np.ones(len(data.index),dtype=bool)
+    if 'Max_Precision' in filters and file_type.get('precision'):
+        keep &= data[file_type['precision']].values <= filters['Max_Precision']
+    if 'Max_Z_Precision' in filters and file_type.get('zprecision'):
+        keep &= data[file_type['zprecision']].values <= filters['Max_Z_Precision']
+    if 'Min_Intensity' in filters and file_type.get('intensity'):
+        keep &= data[file_type['intensity']].values >= filters['Min_Intensity']
+    if 'First_Frame' in filters:
+        keep &= data[file_type['frame']].values >= filters['First_Frame']
+    if 'Last_Frame' in filters:
+        keep &= data[file_type['frame']].values <= filters['Last_Frame']
+    return np.flatnonzero(keep)
+
+def iter_sr_data(t_in,file_type,pix_size=1,chunk_rows=CHUNK_ROWS,filters=None):
+    """
+    Streams the body of a localisations file in blocks of chunk_rows rows
+    and yields the per-channel localisations of each block, so files larger
+    than memory are never read in one go
+    
+    @param t_in:         file object over the body of the localisations file
+                         (see LocalisationBody and DownloadPipe)
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param pix_size:     used to convert localisation coordinates to nm
+    @param chunk_rows:   the number of rows parsed at a time
+    @param filters:      the localisation filters applied to each block,
+                         so rejected rows are never kept (see get_filters)
+    """
+    header_row = file_type['header_row']
+
+    if 'chan_col' in file_type:
+        sizeC = 2
+    else:
+        sizeC = 1
+        
+    if 'palmtracer' in file_type['name']:
+        names = ['track','orig_time','X position (pixel)','Y position (pixel)',\
+                 'good','intensity','extra1','extra2','time']
+    else:
+        names = None
+        
+    dtypes = get_parse_columns(file_type,filters)
+    int_cols = get_int_columns(file_type)
+    reader = pd.read_csv(t_in,header=header_row,names=names,\
+                         sep='\t',engine='c',\
+                         usecols=list(dtypes.keys()),dtype=dtypes,\
+                         index_col=False,chunksize=chunk_rows)
+    for data in reader:
+        # rows without a frame or channel cannot be placed so are dropped
+        missing = data[int_cols].isnull().any(axis=1).values
+        if missing.any():
+            data = data[~missing]
+        data = data.astype(dict((col,np.int32) for col in int_cols))
+        rows = filter_rows(data,file_type,filters)
+        yield get_all_locs(data,sizeC,file_type,pix_size,rows)
+
+def parse_sr_data(path,file_type,pix_size=1,compression=None,filters=None):
+    """
+    Parses all the data in the file being processed, and returns the
+    localisations as an ordered dictionary of column arrays per channel,
+    sorted by frame
+    
+    @param path:         the path of the localisations file being parsed
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param pix_size:     used to convert localisation coordinates to nm
+    @param compression:  the compression of the file (see get_compression)
+    @param filters:      the localisation filters (see get_filters)
+    """
+    s = time.time()
+    try:
+        with open_localisations(path,compression) as t_in:
+            chunks = list(iter_sr_data(t_in,file_type,pix_size,filters=filters))
+    except:
+        print 'there was a problem parsing localisation data'
+        return None
+    print 'reading the file took:',time.time()-s,'seconds'
+    if not chunks:
+        return None
+    coords = [OrderedDict((col,np.concatenate([chunk[c][col] for chunk in chunks]))
+                          for col in chunks[0][c])
+              for c in range(len(chunks[0]))]
+    return [sort_locs(locs,file_type['frame']) for locs in coords]      
+
+def download_data(ann):
+    """
+    Downloads the specified file to and returns the path on the server
+    
+    @param ann:    the file annotation being downloaded
+    """ 
+    cache_file = get_download_cache_path(ann)
+    if cache_file is not None and touch_cached_download(cache_file):
+        print "\nUsing cached download", cache_file
+        return cache_file
+    if not os.path.exists(PATH):
+        os.makedirs(PATH)
+    file_path = os.path.join(PATH, ann.getFile().getName())
+    f = open(str(file_path), 'w')
+    print "\nDownloading file to", file_path, "..."
+    try:
+        for chunk in iter_cached_download(ann):
+            f.write(chunk)
+    finally:
+        f.close()
+        print "File downloaded!"
+    return file_path
+    
+def delete_downloaded_data(ann):
+    """
+    Deletes the downloaded file annoation
+    
+    @param ann:    the file annotation
+    """
+    file_path = os.path.join(PATH, ann.getFile().getName())
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+    shutil.rmtree(PATH)
+    
+def get_cache_key(ann,file_type,pix_size,filters=None):
+    """
+    Returns the key of the cached localisations for a file annotation. The
+    OriginalFile hash and size make sure a replaced file is parsed again
+    
+    @param ann:          the file annotation holding the localisations
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param pix_size:     used to convert localisation coordinates to nm
+    @param filters:      the localisation filters (see get_filters)
+    """
+    orig = ann.getFile()
+    if isinstance(file_type,dict):
+        file_type = sorted(file_type.items())
+    key = '%s:%s:%s:%s:%s:%s' % (CACHE_FORMAT,ann.getId(),orig.getHash(),
+                                 orig.getSize(),file_type,pix_size)
+    if filters:
+        key += ':%s' % sorted(filters.items())
+    return hashlib.sha1(key).hexdigest()
+
+def evict_cache(cache_path,max_bytes,keep=None):
+    """
+    Deletes the least recently used entries in the cache until the
+    cache fits within max_bytes, and any unfinished entries left behind
+    by scripts which were killed while writing them
+    
+    @param cache_path:   the cache directory
+    @param max_bytes:    the size budget of the cache in bytes
+    @param keep:         an entry which must not be evicted
+    """
+    entries = []
+    total = 0
+    now = time.time()
+    for name in os.listdir(cache_path):
+        entry = os.path.join(cache_path,name)
+        if name.startswith('.'):
+            # still being written, unless the script writing it was killed
+            remove_stale_entry(entry,now)
+            continue
+        try:
+            if os.path.isdir(entry):
+                size = sum(os.path.getsize(os.path.join(entry,f))
+                           for f in os.listdir(entry))
+            else:
+                size = os.path.getsize(entry)
+            entries.append((os.path.getmtime(entry),size,entry))
+        except OSError:
+            # removed by another script while we were looking
+            continue
+        total += size
+    for mtime,size,entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        if os.path.isdir(entry):
+            shutil.rmtree(entry,ignore_errors=True)
+        else:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+        total -= size
+
+def remove_stale_entry(entry,now,max_age=STALE_AGE):
+    """
+    Deletes an unfinished cache entry (a file or directory whose name
+    starts with '.') which nothing has written to for max_age seconds
+    
+    @param entry:      the path of the unfinished entry
+    @param now:        the current time
+    @param max_age:    the age in seconds after which the entry is stale
+    """
+    try:
+        paths = [entry]
+        if os.path.isdir(entry):
+            paths += [os.path.join(entry,f) for f in os.listdir(entry)]
+        if now - max(os.path.getmtime(path) for path in paths) < max_age:
+            return
+    except OSError:
+        # finished or removed by another script while we were looking
+        return
+    if os.path.isdir(entry):
+        shutil.rmtree(entry,ignore_errors=True)
+    else:
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+def get_download_cache_path(ann):
+    """
+    Returns the path of the annotation's file in the shared download cache,
+    which is keyed by the OriginalFile hash so every script and user finds
+    the same copy. Returns None if the file has no SHA1 hash, since the
+    download could not be verified before it is shared
+    
+    @param ann:    the file annotation
+    """
+    orig = ann.getFile()
+    sha1 = orig.getHash()
+    if not sha1 or not re.match(r'^[0-9a-fA-F]{40}$',sha1):
+        return None
+    return os.path.join(DOWNLOAD_CACHE_PATH,'%s_%s' % (sha1.lower(),orig.getSize()))
+
+def touch_cached_download(cache_file):
+    """
+    Marks a file in the download cache as recently used. Returns False if
+    the file is not in the cache
+    
+    @param cache_file:    the path of the file in the download cache
+    """
+    try:
+        os.utime(cache_file,None)
+        return True
+    except OSError:
+        return False
+
+def iter_cached_download(ann):
+    """
+    Yields the chunks of the annotation's file as they are downloaded and
+    copies them into the shared download cache. The copy is only added to
+    the cache once the whole file has arrived and its SHA1 matches the
+    OriginalFile hash
+    
+    @param ann:    the file annotation being downloaded
+    """
+    cache_file = get_download_cache_path(ann)
+    if cache_file is None:
+        for chunk in ann.getFileInChunks():
+            yield chunk
+        return
+    try:
+        os.makedirs(DOWNLOAD_CACHE_PATH)
+    except OSError:
+        # already created by another script
+        pass
+    fd,tmp = tempfile.mkstemp(prefix='.',dir=DOWNLOAD_CACHE_PATH)
+    sha1 = hashlib.sha1()
+    try:
+        with os.fdopen(fd,'wb') as f:
+            for chunk in ann.getFileInChunks():
+                f.write(chunk)
+                sha1.update(chunk)
+                yield chunk
+        if sha1.hexdigest() != ann.getFile().getHash().lower():
+            print 'checksum mismatch, not caching the download of',ann.getFile().getName()
+        else:
+            os.rename(tmp,cache_file)
+            evict_cache(DOWNLOAD_CACHE_PATH,DOWNLOAD_CACHE_SIZE,keep=cache_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def write_cached_locs(key,chunks,sort_by=None):
+    """
+    Writes the parsed localisations to the cache as one contiguous binary
+    file per column per channel. Each block of rows is appended as it is
+    parsed so the whole table is never held in memory. Coordinates are
+    stored as float32 and frames as int32
+    
+    @param key:     the cache key (see get_cache_key)
+    @param chunks:  the per-channel localisations of each block of rows
+                    (see iter_sr_data)
+    @param sort_by: the column each channel is sorted by once it has
+                    been written (see sort_cached_chan)
+    """
+    if not os.path.exists(CACHE_PATH):
+        try:
+            os.makedirs(CACHE_PATH)
+        except OSError:
+            pass
+    entry = os.path.join(CACHE_PATH,key)
+    if os.path.exists(entry):
+        return
+    # write to a private directory first so other scripts never see a
+    # partially written entry
+    tmp = tempfile.mkdtemp(prefix='.%s' % key,dir=CACHE_PATH)
+    meta = []
+    try:
+        for chunk in chunks:
+            for c,locs in enumerate(chunk):
+                if c == len(meta):
+                    columns = []
+                    for i,(col,values) in enumerate(locs.items()):
+                        if values.dtype.kind in 'iu':
+                            dtype = np.dtype(np.int32)
+                        else:
+                            dtype = np.dtype(np.float32)
+                        columns.append([col,dtype.str,'c%s_%s.bin' % (c,i)])
+                    meta.append({'rows': 0,'columns': columns})
+                for col,dtype,file_name in meta[c]['columns']:
+                    values = locs[col].astype(dtype)
+                    with open(os.path.join(tmp,file_name),'ab') as f:
+                        values.tofile(f)
+                meta[c]['rows'] += count_locs(locs)
+        if sort_by is not None:
+            for chan in meta:
+                sort_cached_chan(tmp,chan,sort_by)
+        with open(os.path.join(tmp,'meta.json'),'w') as f:
+            json.dump(meta,f)
+    except:
+        shutil.rmtree(tmp,ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp,entry)
+    except OSError:
+        # another script cached the same file first
+        shutil.rmtree(tmp,ignore_errors=True)
+    evict_cache(CACHE_PATH,CACHE_SIZE,keep=entry)
+
+def read_cached_locs(key):
+    """
+    Returns the cached localisations as one ordered dictionary of read-only
+    memory-mapped column arrays per channel, or None if the file annotation
+    has not been cached. Only the pages an analysis touches are read
+    
+    @param key:     the cache key (see get_cache_key)
+    """
+    entry = os.path.join(CACHE_PATH,key)
+    try:
+        with open(os.path.join(entry,'meta.json')) as f:
+            meta = json.load(f)
+        coords = []
+        for chan in meta:
+            locs = OrderedDict()
+            for col,dtype,file_name in chan['columns']:
+                dtype = np.dtype(str(dtype))
+                if chan['rows'] == 0:
+                    # empty files cannot be mapped
+                    locs[col] = np.zeros(0,dtype=dtype)
+                else:
+                    locs[col] = np.memmap(os.path.join(entry,file_name),
+                                          dtype=dtype,mode='r',
+                                          shape=(chan['rows'],))
+            coords.append(locs)
+        # mark as recently used
+        os.utime(entry,None)
+    except (IOError,OSError,ValueError):
+        return None
+    return coords
+
+def sort_locs(locs,sort_by):
+    """
+    Returns the localisations of one channel sorted by the values of the
+    sort_by column, keeping the order of the file for equal values
+    
+    @param locs:       the localisation columns of one channel
+    @param sort_by:    the name of the column to sort by
+    """
+    keys = locs[sort_by]
+    if not (keys[1:] < keys[:-1]).any():
+        return locs
+    order = np.argsort(keys,kind='mergesort')
+    return OrderedDict((col,values.take(order)) for col,values in locs.items())
+
+def sort_cached_chan(path,chan,sort_by):
+    """
+    Sorts the column files of one cached channel by the values of the
+    sort_by column, one column at a time. Files which are already
+    sorted, as most localisation files are by frame, are left untouched
+    
+    @param path:       the directory of the cache entry being written
+    @param chan:       the metadata of the channel (see write_cached_locs)
+    @param sort_by:    the name of the column to sort by
+    """
+    files = dict((col,(dtype,file_name)) for col,dtype,file_name in chan['columns'])
+    if sort_by not in files:
+        return
+    dtype,file_name = files[sort_by]
+    keys = np.fromfile(os.path.join(path,file_name),dtype=np.dtype(dtype))
+    if not (keys[1:] < keys[:-1]).any():
+        return
+    order = np.argsort(keys,kind='mergesort')
+    del keys
+    for col,dtype,file_name in chan['columns']:
+        file_path = os.path.join(path,file_name)
+        np.fromfile(file_path,dtype=np.dtype(dtype)).take(order).tofile(file_path)
+
+def get_localisations(ann,file_type,pix_size=1,filters=None):
+    """
+    Returns the per-channel localisations from the annotation as ordered
+    dictionaries of column arrays sorted by frame. The file is parsed in
+    blocks while it is downloaded, straight into the local cache, and
+    memory-mapped from there, so the full table is never held in memory
+    
+    @param ann:          the file annotation holding the localisations
+    @param file_type:    the type of dataset we are working on
+                         (see FILE_TYPES dictionary)
+    @param pix_size:     used to convert localisation coordinates to nm
+    @param filters:      the localisation filters (see get_filters)
+    """
+    if not os.path.exists(PATH):
+        os.makedirs(PATH)
+    key = get_cache_key(ann,file_type,pix_size,filters)
+    coords = read_cached_locs(key)
+    if coords is not None:
+        print 'using cached localisations for annotation',ann.getId()
+        return coords
+    compression = get_compression(ann.getFile().getName())
+    s = time.time()
+    try:
+        cache_file = get_download_cache_path(ann)
+        if cache_file is not None and touch_cached_download(cache_file):
+            print "\nParsing cached download of annotation", ann.getId(), "..."
+            t_in = open_localisations(cache_file,compression)
+        else:
+            print "\nDownloading and parsing annotation", ann.getId(), "..."
+            chunks = iter_cached_download(ann)
+            if compression is not None:
+                chunks = iter_decompressed(chunks,compression)
+            t_in = DownloadPipe(chunks)
+        with t_in:
+            write_cached_locs(key,iter_sr_data(t_in,file_type,pix_size,filters=filters),
+                              file_type['frame'])
+    except (IOError,OSError) as e:
+        print 'could not cache localisations:',e
+    except:
+        print 'there was a problem parsing localisation data'
+        return None
+    print 'downloading and reading the file took:',time.time()-s,'seconds'
+    coords = read_cached_locs(key)
+    if coords is None:
+        # the cache is not usable so keep the localisations in memory
+        path_to_data = download_data(ann)
+        coords = parse_sr_data(path_to_data,file_type,pix_size,compression,filters)
+        if coords is None:
+            return None
+    print 'sizeC:',len(coords)
+    return coords
+
+
+def get_frame_window(locs,frame,start,stop):
+    """
+    Returns the first and one past the last row of the localisations
+    detected from the start to the stop frame (inclusive), found by
+    binary search of the frame-sorted localisations
+    
+    @param locs:     the localisation columns of one channel
+    @param frame:    the name of the frame column
+    @param start:    the first frame
+    @param stop:     the last frame
+    """
+    frames = locs[frame]
+    return (int(np.searchsorted(frames,start,side='left')),
+            int(np.searchsorted(frames,stop,side='right')))
+
+def get_locs_in_frames(locs,frame,start,stop):
+    """
+    Returns the localisations detected from the start to the stop frame
+    (inclusive) as views of the frame-sorted localisation columns
+    
+    @param locs:     the localisation columns of one channel
+    @param frame:    the name of the frame column
+    @param start:    the first frame
+    @param stop:     the last frame
+    """
+    lo,hi = get_frame_window(locs,frame,start,stop)
+    return OrderedDict((col,values[lo:hi]) for col,values in locs.items())
+
+def count_locs(locs):
+    """
+    Returns the number of localisations in one channel
+    
+    @param locs:     the localisation columns of one channel
+    """
+    return len(next(iter(locs.values())))
+
+def iter_locs_chunks(locs,chunk_rows=CHUNK_ROWS):
+    """
+    Yields consecutive blocks of chunk_rows localisations as views of the
+    localisation columns, for accumulating results with bounded memory
+    
+    @param locs:         the localisation columns of one channel
+    @param chunk_rows:   the number of localisations in each block
+    """
+    for start in range(0,count_locs(locs),chunk_rows):
+        yield OrderedDict((col,values[start:start+chunk_rows])
+                          for col,values in locs.items())
+
+def build_grid_index(locs,x,y,cells=GRID_CELLS):
+    """
+    Returns a spatial index of the localisations of one channel. The
+    localisations are bucketed into a uniform grid and ordered cell by
+    cell, so a rectangle only looks at the cells it overlaps. Built once
+    per channel and shared by every roi
+    
+    @param locs:     the localisation columns of one channel
+    @param x:        the name of the x coordinate column
+    @param y:        the name of the y coordinate column
+    @param cells:    the number of cells along the longer side of the grid
+    """
+    n = count_locs(locs)
+    if n == 0:
+        return None
+    xmin = float(locs[x].min())
+    ymin = float(locs[y].min())
+    cell = max(float(locs[x].max()) - xmin,float(locs[y].max()) - ymin) / cells or 1.0
+    nx = int((float(locs[x].max()) - xmin) / cell) + 1
+    ny = int((float(locs[y].max()) - ymin) / cell) + 1
+    cell_ids = np.empty(n,dtype=np.int32)
+    for start in range(0,n,CHUNK_ROWS):
+        stop = start + CHUNK_ROWS
+        ix = np.clip(((locs[x][start:stop] - xmin) / cell).astype(np.int32),0,nx-1)
+        iy = np.clip(((locs[y][start:stop] - ymin) / cell).astype(np.int32),0,ny-1)
+        cell_ids[start:stop] = iy*nx + ix
+    order = np.argsort(cell_ids,kind='mergesort').astype(np.int32)
+    offsets = np.zeros(nx*ny + 1,dtype=np.int64)
+    np.cumsum(np.bincount(cell_ids,minlength=nx*ny),out=offsets[1:])
+    return {'order': order,'offsets': offsets,'origin': (xmin,ymin),
+            'cell': cell,'shape': (nx,ny)}
+
+def get_rows_in_roi(locs,x,y,box,index=None):
+    """
+    Returns the sorted row numbers of the localisations strictly inside
+    the box. With a spatial index only the localisations in the
+    overlapping cells are tested, otherwise the whole channel is scanned
+    
+    @param locs:     the localisation columns of one channel
+    @param x:        the name of the x coordinate column
+    @param y:        the name of the y coordinate column
+    @param box:      [xstart,xstop,ystart,ystop] of the region
+    @param index:    the spatial index of the channel (see build_grid_index)
+    """
+    xstart,xstop,ystart,ystop = box
+    if index is None:
+        inside = (locs[x] > xstart) & (locs[x] < xstop)\
+                 & (locs[y] > ystart) & (locs[y] < ystop)
+        return np.flatnonzero(inside)
+    xmin,ymin = index['origin']
+    cell = index['cell']
+    nx,ny = index['shape']
+    # widen by a cell so rounding at the cell edges never loses a point
+    ix0 = max(int(np.floor((xstart - xmin) / cell)) - 1,0)
+    ix1 = min(int(np.floor((xstop - xmin) / cell)) + 1,nx-1)
+    iy0 = max(int(np.floor((ystart - ymin) / cell)) - 1,0)
+    iy1 = min(int(np.floor((ystop - ymin) / cell)) + 1,ny-1)
+    if ix0 > ix1 or iy0 > iy1:
+        return np.zeros(0,dtype=np.int32)
+    order = index['order']
+    offsets = index['offsets']
+    # the cells of one grid row are contiguous in the index order
+    rows = np.concatenate([order[offsets[iy*nx+ix0]:offsets[iy*nx+ix1+1]]
+                           for iy in range(iy0,iy1+1)])
+    rows.sort()
+    xs = locs[x].take(rows)
+    ys = locs[y].take(rows)
+    return rows[(xs > xstart) & (xs < xstop) & (ys > ystart) & (ys < ystop)]
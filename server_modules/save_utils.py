@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers for saving the links and annotations created by the scripts in
+batches, one server call per batch rather than per object. Has to be
+installed on the server's python path (see server_modules/README)
+"""
+import omero
+from omero.rtypes import rstring
+
+SAVE_BATCH = 100 # links and annotations saved per server call
+
+def save_in_batches(conn,objects,batch_size=SAVE_BATCH):
+    """
+    Saves new links, annotations and other objects batch_size at a time,
+    one server call per batch rather than per object, and returns the
+    saved objects
+    
+    @param conn:          the BlitzGateWay connection
+    @param objects:       the unsaved objects
+    @param batch_size:    the number of objects saved per call
+    """
+    updateService = conn.getUpdateService()
+    saved = []
+    for start in range(0,len(objects),batch_size):
+        saved.extend(updateService.saveAndReturnArray(objects[start:start+batch_size]))
+    return saved
+
+def new_image_links(dataset_id,image_ids):
+    """
+    Returns new (unsaved) links of the images to the dataset, to be saved
+    with save_in_batches
+    
+    @param dataset_id:    the id of the dataset
+    @param image_ids:     the ids of the images
+    """
+    links = []
+    for iid in image_ids:
+        dsLink = omero.model.DatasetImageLinkI()
+        dsLink.parent = omero.model.DatasetI(dataset_id, False)
+        dsLink.child = omero.model.ImageI(iid, False)
+        links.append(dsLink)
+    return links
+
+def new_file_annotation_link(conn,file_name,image_id,mimetype=None,desc=None,ns=None):
+    """
+    Uploads the file and returns a new (unsaved) link of a file annotation
+    of it to the image. The annotation is created when the link is saved
+    with save_in_batches
+    
+    @param conn:          the BlitzGateWay connection
+    @param file_name:     the path of the local file
+    @param image_id:      the id of the image being annotated
+    @param mimetype:      the mimetype of the file
+    @param desc:          the description of the annotation
+    @param ns:            the namespace of the annotation
+    """
+    orig_file = conn.createOriginalFileFromLocalFile(file_name,mimetype=mimetype,ns=ns)
+    file_ann = omero.model.FileAnnotationI()
+    file_ann.setFile(omero.model.OriginalFileI(orig_file.getId(), False))
+    if desc:
+        file_ann.setDescription(rstring(desc))
+    if ns:
+        file_ann.setNs(rstring(ns))
+    link = omero.model.ImageAnnotationLinkI()
+    link.parent = omero.model.ImageI(image_id, False)
+    link.child = file_ann
+    return link